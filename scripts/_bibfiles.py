@@ -2,8 +2,14 @@
 
 import os
 import io
+import marshal
+import hashlib
+import tempfile
 import datetime
+import itertools
 import ConfigParser
+import collections
+import multiprocessing
 
 import _bibtex
 from _bibfiles_db import Database
@@ -14,6 +20,8 @@ DIR = '../references/bibtex'
 
 CONFIG = 'BIBFILES.ini'
 
+CACHE = '_bibfiles_cache'
+
 
 class Collection(list):
     """Directory with an INI-file with settings for BibTeX files inside."""
@@ -21,7 +29,7 @@ class Collection(list):
     _encoding = 'utf-8-sig'
 
     @classmethod
-    def _bibfiles(cls, directory, config, endwith):
+    def _bibfiles(cls, directory, config, endwith, cache=None):
         """Read the INI-file, yield bibfile instances for sections."""
         config = os.path.join(directory, config)
         cfg = ConfigParser.RawConfigParser()
@@ -41,11 +49,12 @@ class Collection(list):
                 priority=cfg.getint(s, 'priority'),
                 name=cfg.get(s, 'name'), title=cfg.get(s, 'title'),
                 description=cfg.get(s, 'description'),
-                abbr=cfg.get(s, 'abbr'))
+                abbr=cfg.get(s, 'abbr'), cache=cache)
 
-    def __init__(self, directory=DIR, config=CONFIG, endwith='.bib'):
+    def __init__(self, directory=DIR, config=CONFIG, endwith='.bib', cache=CACHE):
         self.directory = directory
-        bibfiles = self._bibfiles(directory, config, endwith)
+        self.cache = EntryCache(cache) if cache is not None else None
+        bibfiles = self._bibfiles(directory, config, endwith, self.cache)
         super(Collection, self).__init__(bibfiles)
         self._map = {b.filename: b for b in self}
 
@@ -55,15 +64,33 @@ class Collection(list):
             return self._map[index_or_filename]
         return super(Collection, self).__getitem__(index_or_filename)
 
-    def to_sqlite(self, filename=None, rebuild=False):
+    def to_sqlite(self, filename=None, rebuild=False, incremental=False,
+                  packed=False, jobs=1):
         """Return a database with the bibfiles loaded."""
-        return Database.from_bibfiles(self, filename, rebuild=rebuild)
+        return Database.from_bibfiles(self, filename, rebuild=rebuild,
+            incremental=incremental, packed=packed, jobs=jobs)
+
+    def check_all(self, jobs=None):
+        """Check the BibTeX syntax, names, and macros of all bibfiles in parallel.
+
+        Return the list of _bibtex.CheckErrors (jobs=None uses all cpus).
+        """
+        if jobs == 1:
+            results = itertools.imap(_check_bibfile, self)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap(_check_bibfile, self)
+        try:
+            errors = []
+            for b, (count, invalid) in itertools.izip(self, results):
+                b._print_check(count, invalid)
+                errors.extend(invalid)
+        finally:
+            if jobs != 1:
+                pool.terminate()
+                pool.join()
+        return errors
 
-    def check_all(self):
-        """Check the BibTeX syntax of all bibfiles."""
-        for b in self:
-            b.check()
-            
     def roundtrip_all(self):
         """Load and save all bibfiles with the current settings."""
         for b in self:
@@ -74,7 +101,7 @@ class BibFile(object):
     """BibTeX source file with configurable load/save options and meta data."""
 
     def __init__(self, filepath, encoding, sortkey, use_pybtex=True, priority=0,
-                 name=None, title=None, description=None, abbr=None):
+                 name=None, title=None, description=None, abbr=None, cache=None):
         self.filepath = filepath
         self.filename = os.path.basename(filepath)
         self.encoding = encoding
@@ -85,6 +112,8 @@ class BibFile(object):
         self.title = title
         self.description = description
         self.abbr = abbr
+        self.cache = cache
+        self._index = None
 
     @property
     def size(self):
@@ -94,37 +123,99 @@ class BibFile(object):
     def mtime(self):
         return datetime.datetime.fromtimestamp(os.stat(self.filepath).st_mtime)
 
-    def iterentries(self):
-        """Yield entries as (bibkey, (entrytype, fields)) tuples."""
+    @property
+    def digest(self):
+        return _bibtex.digest(self.filepath)
+
+    def iterentries(self, cached=True, spans=False, bibkeys=None):
+        """Yield entries as (bibkey, (entrytype, fields)) tuples.
+
+        With spans, parse the file and yield ((start, end), entry) pairs with
+        the byte span of each entry (see rewrite). With bibkeys, parse the file
+        and only yield the entries with these keys.
+        """
+        if cached and not spans and bibkeys is None and self.cache is not None:
+            return iter(self.cache.entries(self))
         return _bibtex.iterentries(filename=self.filepath,
             encoding=self.encoding,
-            use_pybtex=self.use_pybtex)
+            use_pybtex=self.use_pybtex,
+            spans=spans, bibkeys=bibkeys)
 
-    def load(self):
+    def load(self, cached=True):
         """Return entries as bibkey -> (entrytype, fields) dict."""
+        if cached and self.cache is not None:
+            cls = collections.OrderedDict if self.sortkey is None else dict
+            return cls(self.cache.entries(self))
         return _bibtex.load(filename=self.filepath,
             preserve_order=self.sortkey is None,
             encoding=self.encoding,
             use_pybtex=self.use_pybtex)
 
     def save(self, entries, verbose=True):
-        """Write bibkey -> (entrytype, fields) map to file."""
-        _bibtex.save(entries,
+        """Write bibkey -> (entrytype, fields) map to file, return LaTeX diagnostics."""
+        return _bibtex.save(entries,
             filename=self.filepath,
             sortkey=self.sortkey,
             encoding=self.encoding,
             use_pybtex=self.use_pybtex,
             verbose=verbose)
 
+    def index(self):
+        """Return the bibkey -> (offset, length) index of the entries."""
+        return self._positions()[0]
+
+    def _positions(self):
+        """Return the entry index and the @string spans (see _bibtex.index).
+
+        They are kept in the cache (if any) and rebuilt when the content changes.
+        """
+        if self.cache is not None:
+            return self.cache.index(self)
+        stat = os.stat(self.filepath)
+        stamp = stat.st_size, stat.st_mtime
+        if self._index is None or self._index[0] != stamp:
+            self._index = stamp, _bibtex.index(self.filepath, self.encoding)
+        return self._index[1]
+
+    def __contains__(self, bibkey):
+        return bibkey in self.index()
+
+    def __getitem__(self, bibkey):
+        """Return the (entrytype, fields) of bibkey (only parsing this entry)."""
+        index, strings = self._positions()
+        for _, entry in _bibtex.iterentries_at(self.filepath, [index[bibkey]], self.encoding, strings):
+            return entry
+
+    def get_many(self, bibkeys):
+        """Return a bibkey -> (entrytype, fields) dict for the bibkeys in the file."""
+        index, strings = self._positions()
+        offsets = sorted(index[b] for b in set(bibkeys) if b in index)
+        return dict(_bibtex.iterentries_at(self.filepath, offsets, self.encoding, strings))
+
+    def rewrite(self, replacements, verbose=True):
+        """Replace the entries at the given spans, keep the rest of the file."""
+        return _bibtex.rewrite(filename=self.filepath,
+            replacements=replacements,
+            encoding=self.encoding,
+            use_pybtex=self.use_pybtex,
+            verbose=verbose)
+
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.filename)
 
     def check(self):
+        """Check BibTeX syntax, names, and macros, return the list of _bibtex.CheckErrors."""
+        count, invalid = _check_bibfile(self)
+        self._print_check(count, invalid)
+        return invalid
+
+    def _print_check(self, count, invalid):
         print(self)
-        entries = self.load()  # bare BibTeX syntax
-        invalid = _bibtex.check(filename=self.filepath)  # names/macros etc.
-        verdict = ('(%d invalid)' % invalid) if invalid else 'OK'
-        print('%d %s' % (len(entries), verdict))
+        for e in invalid:
+            line = u'%s:%s: %s: %s: %s' % (e.filename, e.lineno, e.bibkey, e.error, e.message)
+            print(line.encode('ascii', 'backslashreplace'))  # also for pipes/redirected stdout
+        verdict = ('(%d invalid)' % len(invalid)) if invalid else 'OK'
+        print('%d %s' % (count, verdict))
 
     def roundtrip(self):
         print(self)
@@ -132,7 +223,6 @@ class BibFile(object):
 
     def show_characters(self, include_plain=False):
         """Display character-frequencies (excluding printable ASCII)."""
-        import collections
         from unicodedata import name
 
         with io.open(self.filepath, encoding=self.encoding) as fd:
@@ -144,6 +234,125 @@ class BibFile(object):
         print(table)
 
 
+def _check_bibfile(bibfile):
+    return _bibtex.check(filename=bibfile.filepath, encoding=bibfile.encoding)
+
+
+class EntryCache(object):
+    """Directory with parsed bibfile entries and entry indexes (keyed by path, digest, and settings)."""
+
+    version = 1, _bibtex.PARSER_VERSION  # cache layout, parser output
+
+    def __init__(self, directory=CACHE):
+        self.directory = directory
+        self._indexes = {}
+
+    def _key(self, bibfile):
+        return (os.path.abspath(bibfile.filepath), bibfile.encoding, bibfile.use_pybtex)
+
+    def _filepath(self, key, suffix='.marshal'):
+        digest = hashlib.sha1(repr((self.version,) + key)).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def _load(self, filepath):
+        try:
+            with open(filepath, 'rb') as fd:
+                return marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, filepath, data):
+        """Write to a temporary file renamed into place (no partial files for readers)."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with tempfile.NamedTemporaryFile(dir=self.directory,
+                prefix=os.path.basename(filepath), suffix='.tmp', delete=False) as fd:
+            try:
+                marshal.dump(data, fd.file, 2)
+            except:
+                fd.close()
+                os.remove(fd.name)
+                raise
+        os.rename(fd.name, filepath)
+
+    def entries(self, bibfile):
+        """Return the list of entries from the cache if fresh, otherwise parse and store."""
+        key = self._key(bibfile)
+        filepath = self._filepath(key)
+        digest = bibfile.digest
+        cached = self._load(filepath)
+        if cached is not None:
+            cached_key, cached_digest, entries = cached
+            if cached_key == key and cached_digest == digest:
+                return entries
+        entries = list(bibfile.iterentries(cached=False))
+        self._store(filepath, (key, digest, entries))
+        return entries
+
+    def index(self, bibfile):
+        """Return the entry index and @string spans from memory or the cache if fresh.
+
+        Unchanged size and mtime count as fresh, otherwise the digest is compared.
+        """
+        key = self._key(bibfile)
+        stat = os.stat(bibfile.filepath)
+        stamp = stat.st_size, stat.st_mtime
+        memo = self._indexes.get(key)
+        if memo is not None and memo[0] == stamp:
+            return memo[1]
+        filepath = self._filepath(key, '.index')
+        cached = self._load(filepath)
+        index = None
+        if cached is not None:
+            cached_key, cached_stamp, digest, index = cached
+            if cached_key != key or cached_stamp[0] != stamp[0]:
+                index = None
+            elif cached_stamp != stamp:
+                if digest == bibfile.digest:
+                    self._store(filepath, (key, stamp, digest, index))
+                else:
+                    index = None
+        if index is None:
+            digest = bibfile.digest
+            index = _bibtex.index(bibfile.filepath, bibfile.encoding)
+            self._store(filepath, (key, stamp, digest, index))
+        self._indexes[key] = stamp, index
+        return index
+
+    def clear(self):
+        """Remove all cached entries and indexes."""
+        self._indexes.clear()
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(('.marshal', '.index')):
+                    os.remove(os.path.join(self.directory, filename))
+
+
+def _test_check_nonascii():
+    """Check a bibfile with an error in a non-ASCII bibkey, printing to a byte stream."""
+    import sys
+    import shutil
+    import cStringIO
+
+    directory = tempfile.mkdtemp(prefix='_bibfiles')
+    try:
+        filepath = os.path.join(directory, 'nonascii.bib')
+        with io.open(filepath, 'w', encoding='utf-8') as fd:
+            fd.write(u'@book{k\xe4,\n  title = undef\n}\n')
+        b = BibFile(filepath, 'utf-8', None)
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()  # no encoding, like a pipe
+        try:
+            invalid = b.check()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(directory)
+    assert [(e.bibkey, e.error) for e in invalid] == [(u'k\xe4', 'UndefinedMacro')]
+    assert 'k\\xe4: UndefinedMacro' in output, output
+    assert output.endswith('1 (1 invalid)\n'), output
+
+
 if __name__ == '__main__':
     c = Collection()
     d = Database()
@@ -1,21 +1,31 @@
 # _bibfiles_db.py - load bibfiles into sqlite3, hash, assign ids (split/merge)
 
 import os
+import sys
 import csv
+import time
+import Queue
 import json
+import shutil
 import sqlite3
 import difflib
 import operator
+import tempfile
 import itertools
+import threading
 import contextlib
 import collections
+import multiprocessing
 
 import _bibtex
+from _bibtex_vocabulary import Vocabulary
 
 __all__ = ['Database']
 
 DBFILE = '_bibfiles.sqlite3'
 
+SCHEMA_VERSION = 1  # increment on every change of the tables created by create_tables
+
 BIBFILE = 'monster-utf8.bib'
 
 CSVFILE = '../references/monster.csv'
@@ -44,15 +54,33 @@ class Database(object):
         return filename
 
     @classmethod
-    def from_bibfiles(cls, bibfiles=None, filename=None, rebuild=False):
-        """If needed, (re)build the db from the bibfiles, hash, split/merge."""
+    def from_bibfiles(cls, bibfiles=None, filename=None, rebuild=False,
+                      incremental=False, packed=False, jobs=1):
+        """If needed, (re)build the db from the bibfiles, hash, split/merge.
+
+        With packed=True, the entry table also holds the fields of each entry
+        as JSON together with its priority, so that merged entries are read
+        from the entry table only (without joining the value table). An
+        existing db with the other layout is rebuilt.
+
+        With incremental=True, an outdated db is not rebuilt from scratch:
+        only changed, added, or removed bibfiles are reimported (see reimport).
+
+        With jobs != 1, parse the bibfiles in a pool of worker processes
+        (jobs=None: one per cpu), inserting into the db from this process.
+        """
         bibfiles = cls._get_bibfiles(bibfiles)
         filename = cls._get_filename(filename)
             
         if os.path.exists(filename):
             if not rebuild:
                 self = cls(filename)
-                if self.is_uptodate():
+                if self.is_current_schema() and self.is_packed() != packed:
+                    print('rebuild db with packed=%r' % packed)
+                elif self.is_uptodate(bibfiles):
+                    return self
+                elif incremental and self.is_current_schema():
+                    self.reimport(bibfiles, jobs=jobs)
                     return self
             os.remove(filename)
 
@@ -60,12 +88,13 @@ class Database(object):
         with self.connect(async=True) as conn:
             create_tables(conn)
             with conn:
-                import_bibfiles(conn, bibfiles)
+                import_bibfiles(conn, bibfiles, packed=packed, jobs=jobs)
+            create_indexes(conn)
             entrystats(conn)
             fieldstats(conn)
 
             with conn:
-                generate_hashes(conn)
+                generate_hashes(conn, jobs=jobs)
             hashstats(conn)
             hashidstats(conn)
 
@@ -78,17 +107,50 @@ class Database(object):
         self.filename = self._get_filename(filename)
 
     def is_uptodate(self, bibfiles=None, verbose=False):
-        """Does the db have the same filenames, sizes, and mtimes as bibfiles?"""
+        """Does the db have the current schema, same filenames and file contents as bibfiles?"""
         bibfiles = self._get_bibfiles(bibfiles)
-        with self.connect() as conn:
+        if not self.is_current_schema():
+            if verbose:
+                print('outdated db schema')
+            return False
+        with self.connect() as conn, conn:
             return compare_bibfiles(conn, bibfiles, verbose=verbose)
 
-    def recompute(self, hashes=True, reload_priorities=True, verbose=True):
-        """Call _libmonster.keyid for all entries, splits/merges -> new ids."""
+    def is_current_schema(self):
+        """Was the db created with the current table layout (SCHEMA_VERSION)?"""
+        with self.connect() as conn:
+            try:
+                version, = conn.execute('PRAGMA user_version').fetchone()
+            except sqlite3.DatabaseError:
+                return False
+        return version == SCHEMA_VERSION
+
+    def is_packed(self):
+        """Was the db built with packed=True?"""
+        with self.connect() as conn:
+            return ispacked(conn)
+
+    def reimport(self, bibfiles=None, jobs=1, verbose=False):
+        """Reload changed/added/removed bibfiles only, then recompute hashes/ids."""
+        bibfiles = self._get_bibfiles(bibfiles)
+        with self.connect(async=True) as conn:
+            with conn:
+                reimport_bibfiles(conn, bibfiles, jobs=jobs)
+            entrystats(conn)
+        self.recompute(reload_priorities=bibfiles, verbose=verbose,
+            incremental=True, jobs=jobs)
+
+    def recompute(self, hashes=True, reload_priorities=True, verbose=True,
+                  incremental=False, jobs=1):
+        """Call _libmonster.keyid for all entries, splits/merges -> new ids.
+
+        With incremental=True, only rehash new entries and entries whose rare
+        title word selection is changed by the new title word frequencies.
+        """
         with self.connect(async=True) as conn:
             if hashes:
                 with conn:
-                    generate_hashes(conn)
+                    generate_hashes(conn, incremental=incremental, jobs=jobs)
                 hashstats(conn)
                 hashidstats(conn)
             if reload_priorities:
@@ -123,14 +185,23 @@ class Database(object):
         with open(filename, 'wb') as fd:
             json.dump(pairs, fd, indent=4)
 
+    def vocabulary(self):
+        """Return the title word Vocabulary of the current hashes."""
+        with self.connect() as conn:
+            return load_vocabulary(conn)
+
     def to_hhmapping(self):
         with self.connect() as conn:
             assert allid(conn)
             query = 'SELECT bibkey, id FROM entry WHERE filename = ?'
             return dict(conn.execute(query, ('hh.bib',)))
 
-    def trickle(self, bibfiles=None):
-        """Write new/changed glottolog_ref_ids back into the bibfiles."""
+    def trickle(self, bibfiles=None, inplace=False):
+        """Write new/changed glottolog_ref_ids back into the bibfiles.
+
+        With inplace, only the blocks of the changed entries are rewritten
+        (the rest of the file is copied unchanged instead of saving all entries).
+        """
         bibfiles = self._get_bibfiles(bibfiles)
         if not self.is_uptodate(bibfiles, verbose=True):
             raise RuntimeError('trickle with an outdated db')
@@ -140,12 +211,19 @@ class Database(object):
                 'AND id != coalesce(refid, -1)) ORDER BY name').fetchall()
             for f, in filenames:
                 b = bibfiles[f]
-                entries = b.load()
                 cursor = conn.execute('SELECT bibkey, cast(refid AS text), cast(id AS text) '
                     'FROM entry WHERE filename = ? AND id != coalesce(refid, -1) '
                     'ORDER BY lower(bibkey)', (f,))
+                updates = cursor.fetchall()
+                if inplace:
+                    keys = {bibkey for bibkey, _, _ in updates}
+                    spans = {bibkey: (span, entry) for span, (bibkey, entry)
+                        in b.iterentries(spans=True, bibkeys=keys)}
+                    entries = {bibkey: entry for bibkey, (_, entry) in spans.iteritems()}
+                else:
+                    entries = b.load()
                 added = changed = 0
-                for bibkey, refid, new in cursor:
+                for bibkey, refid, new in updates:
                     entrytype, fields = entries[bibkey]
                     old = fields.pop('glottolog_ref_id', None)
                     assert old == refid
@@ -155,11 +233,19 @@ class Database(object):
                         changed += 1
                     fields['glottolog_ref_id'] = new
                 print('%d changed %d added in %s' % (changed, added, b.filename))
-                b.save(entries)
-
-    def merged(self):
-        """Yield merged (bibkey, (entrytype, fields)) entries."""
-        for (id, hash), grp in self:
+                if inplace:
+                    b.rewrite({span: (bibkey, entry) for bibkey, (span, entry) in spans.iteritems()})
+                else:
+                    b.save(entries)
+
+    def merged(self, chunksize=100, prefetch=0):
+        """Yield merged (bibkey, (entrytype, fields)) entries.
+
+        Entries are fetched in windows of chunksize ids. With prefetch > 0, a
+        background thread with its own connection fetches up to prefetch
+        windows ahead while the current one is merged.
+        """
+        for (id, hash), grp in self.__iter__(chunksize, prefetch):
             entrytype, fields = self._merged_entry(grp)
             fields['glottolog_ref_id'] = id
             yield hash, (entrytype, fields)
@@ -173,7 +259,7 @@ class Database(object):
             conn = contextlib.closing(conn)
         return conn
 
-    def __iter__(self, chunksize=100):
+    def __iter__(self, chunksize=100, prefetch=0):
         with self.connect() as conn:
             assert allid(conn)
 
@@ -184,19 +270,17 @@ class Database(object):
 
             assert onetoone(conn)
 
-            get_id_hash, get_field = operator.itemgetter(0, 1), operator.itemgetter(2)
-            for first, last in windowed(conn, 'id', chunksize):
-                cursor = conn.execute('SELECT e.id, e.hash, v.field, v.value, v.filename, v.bibkey '
-                    'FROM entry AS e '
-                    'JOIN file AS f ON e.filename = f.name '
-                    'JOIN value AS v ON e.filename = v.filename AND e.bibkey = v.bibkey '
-                    'LEFT JOIN field AS d ON v.filename = d.filename AND v.field = d.field '
-                    'WHERE e.id BETWEEN ? AND ? '
-                    'ORDER BY e.id, v.field, coalesce(d.priority, f.priority) DESC, v.filename, v.bibkey',
-                    (first, last))
-                for id_hash, grp in itertools.groupby(cursor, get_id_hash):
-                    yield (id_hash, [(field, [(vl, fn, bk) for id, hs, fd, vl, fn, bk in g])
-                        for field, g in itertools.groupby(grp, get_field)])
+            packed = ispacked(conn)
+            overrides = fieldpriorities(conn) if packed else None
+            if not prefetch:
+                for id_hash, grp in itergrps(windowrows(conn, chunksize, packed), overrides):
+                    yield id_hash, grp
+                return
+
+        windows = prefetched(self.connect,
+            lambda conn: windowrows(conn, chunksize, packed), prefetch)
+        for id_hash, grp in itergrps(windows, overrides):
+            yield id_hash, grp
 
     def __getitem__(self, key):
         """Entry by (fn, bk) or merged entry by refid (old grouping) or hash (current grouping)."""
@@ -213,9 +297,14 @@ class Database(object):
 
     @staticmethod
     def _entry(conn, filename, bibkey, raw=False):
-        cursor = conn.execute('SELECT field, value FROM value '
-            'WHERE filename = ? AND bibkey = ? ', (filename, bibkey))
-        fields = dict(cursor)
+        if ispacked(conn):
+            row = conn.execute('SELECT fields FROM entry '
+                'WHERE filename = ? AND bibkey = ?', (filename, bibkey)).fetchone()
+            fields = json.loads(row[0]) if row is not None else None
+        else:
+            cursor = conn.execute('SELECT field, value FROM value '
+                'WHERE filename = ? AND bibkey = ? ', (filename, bibkey))
+            fields = dict(cursor)
         if not fields:
             raise KeyError((filename, bibkey))
         if raw:
@@ -240,21 +329,36 @@ class Database(object):
         return entrytype, fields
 
     @staticmethod
-    def _entrygrp(conn, key, get_field=operator.itemgetter(0)):
+    def _entrygrp(conn, key):
         col = 'refid' if isinstance(key, int) else 'hash'
-        cursor = conn.execute(('SELECT v.field, v.value, v.filename, v.bibkey '
+        for _, grp in Database._entrygrps(conn, col, [key]):
+            return grp
+        raise KeyError(key)
+
+    @staticmethod
+    def _entrygrps(conn, col, keys, get_key=operator.itemgetter(0),
+                   get_field=operator.itemgetter(1)):
+        """Yield (key, grp) pairs for the entry groups with col in keys."""
+        if ispacked(conn):
+            overrides = fieldpriorities(conn)
+            cursor = conn.execute(('SELECT %(col)s, filename, bibkey, priority, fields '
+                'FROM entry WHERE %(col)s IN (%(keys)s) ORDER BY %(col)s'
+                ) % {'col': col, 'keys': ', '.join('?' * len(keys))}, keys)
+            for key, rows in itertools.groupby(cursor, get_key):
+                yield key, packedgrp((row[1:] for row in rows), overrides)
+            return
+
+        cursor = conn.execute(('SELECT e.%(col)s, v.field, v.value, v.filename, v.bibkey '
             'FROM entry AS e '
             'JOIN file AS f ON e.filename = f.name '
             'JOIN value AS v ON e.filename = v.filename AND e.bibkey = v.bibkey '
             'LEFT JOIN field AS d ON v.filename = d.filename AND v.field = d.field '
-            'WHERE %s = ? '
-            'ORDER BY v.field, coalesce(d.priority, f.priority) DESC, v.filename, v.bibkey'
-            ) % col, (key,))
-        grp = [(field, [(vl, fn, bk) for fd, vl, fn, bk in g])
-            for field, g in itertools.groupby(cursor, get_field)]
-        if not grp:
-            raise KeyError(key)
-        return grp
+            'WHERE e.%(col)s IN (%(keys)s) '
+            'ORDER BY e.%(col)s, v.field, coalesce(d.priority, f.priority) DESC, v.filename, v.bibkey'
+            ) % {'col': col, 'keys': ', '.join('?' * len(keys))}, keys)
+        for key, rows in itertools.groupby(cursor, get_key):
+            yield key, [(field, [(vl, fn, bk) for k, fd, vl, fn, bk in g])
+                for field, g in itertools.groupby(rows, get_field)]
 
     def stats(self, field_files=False):
         with self.connect() as conn:
@@ -269,15 +373,18 @@ class Database(object):
             'FROM entry AS e WHERE EXISTS (SELECT 1 FROM entry '
             'WHERE refid = e.refid AND hash != e.hash) '
             'ORDER BY refid, hash, filename, bibkey')
-            for refid, group in group_first(cursor):
+            groups = list(group_first(cursor))
+            merged_entries = MergedEntries(conn)
+            merged_entries.load(k for refid, group in groups
+                for k in itertools.chain([refid], (hs for ri, hs, fn, bk in group)))
+            for refid, group in groups:
                 for row in group:
                     print(row)
                 for ri, hs, fn, bk in group:
                     print('\t%r, %r, %r, %r' % hashfields(conn, fn, bk))
-                old = self._merged_entry(self._entrygrp(conn, refid), raw=True)
-                cand = [(hs, self._merged_entry(self._entrygrp(conn, hs), raw=True))
-                    for hs in unique(hs for ri, hs, fn, bk in group)]
-                new = min(cand, key=lambda (hs, fields): distance(old, fields))[0]
+                old = merged_entries[refid]
+                cand = [(hs, merged_entries[hs]) for hs in unique(hs for ri, hs, fn, bk in group)]
+                new = closest(old, cand)
                 print('-> %s\n' % new)
 
     def show_merges(self):
@@ -286,15 +393,18 @@ class Database(object):
             'FROM entry AS e WHERE EXISTS (SELECT 1 FROM entry '
             'WHERE hash = e.hash AND refid != e.refid) '
             'ORDER BY hash, refid DESC, filename, bibkey')
-            for hash, group in group_first(cursor):
+            groups = list(group_first(cursor))
+            merged_entries = MergedEntries(conn)
+            merged_entries.load(k for hash, group in groups
+                for k in itertools.chain([hash], (ri for hs, ri, fn, bk in group)))
+            for hash, group in groups:
                 for row in group:
                     print(row)
                 for hs, ri, fn, bk in group:
                     print('\t%r, %r, %r, %r' % hashfields(conn, fn, bk))
-                new = self._merged_entry(self._entrygrp(conn, hash), raw=True)
-                cand = [(ri, self._merged_entry(self._entrygrp(conn, ri), raw=True))
-                    for ri in unique(ri for hs, ri, fn, bk in group)]
-                old = min(cand, key=lambda (ri, fields): distance(new, fields))[0]
+                new = merged_entries[hash]
+                cand = [(ri, merged_entries[ri]) for ri in unique(ri for hs, ri, fn, bk in group)]
+                old = closest(new, cand)
                 print('-> %s\n' % old)
 
     def show_identified(self):
@@ -330,10 +440,12 @@ class Database(object):
 def create_tables(conn, page_size=32768):
     if page_size is not None:
         conn.execute('PRAGMA page_size = %d' % page_size)
+    conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
     conn.execute('CREATE TABLE file ('
         'name TEXT NOT NULL, '
         'size INTEGER NOT NULL, '
         'mtime DATETIME NOT NULL, '
+        'digest TEXT NOT NULL, '  # sha1 of the content (mtime is only a pre-check)
         'priority INTEGER NOT NULL, '
         'PRIMARY KEY (name))')
     conn.execute('CREATE TABLE field ('
@@ -349,12 +461,12 @@ def create_tables(conn, page_size=32768):
         'hash TEXT, '      # current groupings, m:n with refid (splits/merges)
         'srefid INTEGER, ' # split-resolved refid (every srefid maps to exactly one hash)
         'id INTEGER, '     # new glottolog_ref_id to save into the bibfiles (current hash groupings)
+        'hashwords TEXT, ' # title word types the rare words of the hash are selected from (from count_titlewords)
+        'rarewords TEXT, ' # selected rare title words (NULL: needs rehash)
+        'priority INTEGER, ' # packed layout: file priority
+        'fields TEXT, '    # packed layout: JSON object of the value rows
         'PRIMARY KEY (filename, bibkey), '
         'FOREIGN KEY (filename) REFERENCES file(name))')
-    conn.execute('CREATE INDEX ix_refid ON entry(refid)')
-    conn.execute('CREATE INDEX ix_hash ON entry(hash)')
-    conn.execute('CREATE INDEX ix_srefid ON entry(srefid)')
-    conn.execute('CREATE INDEX ix_id ON entry(id)')
     conn.execute('CREATE TABLE value ('
         'filename TEXT NOT NULL, '
         'bibkey TEXT NOT NULL, '
@@ -362,20 +474,123 @@ def create_tables(conn, page_size=32768):
         'value TEXT NOT NULL, '
         'PRIMARY KEY (filename, bibkey, field), '
         'FOREIGN KEY (filename, bibkey) REFERENCES entry(filename, bibkey))')
+    conn.execute('CREATE TABLE titleword ('
+        'filename TEXT NOT NULL, '
+        'word TEXT NOT NULL, '
+        'count INTEGER NOT NULL, '
+        'PRIMARY KEY (filename, word), '
+        'FOREIGN KEY (filename) REFERENCES file(name))')
+    conn.execute('CREATE TABLE wordfreq ('  # title word frequencies of the current hashes
+        'id INTEGER NOT NULL, '  # dense Vocabulary id
+        'word TEXT NOT NULL, '
+        'count INTEGER NOT NULL, '
+        'PRIMARY KEY (id), '
+        'UNIQUE (word))')
  
 
-def import_bibfiles(conn, bibfiles):
-    for b in bibfiles:
+def create_indexes(conn):
+    """Create the secondary entry indexes (after the bulk load)."""
+    conn.execute('CREATE INDEX ix_refid ON entry(refid)')
+    conn.execute('CREATE INDEX ix_hash ON entry(hash)')
+    conn.execute('CREATE INDEX ix_srefid ON entry(srefid)')
+    # covers the entry side of the id windows of Database.__iter__ (id range with
+    # hash and the value join keys), the joined value rows are still sorted in a temp b-tree
+    conn.execute('CREATE INDEX ix_id ON entry(id, hash, filename, bibkey)')
+
+
+def import_bibfiles(conn, bibfiles, packed=False, jobs=1, chunksize=10000):
+    """Insert the bibfile entries with executemany in batches of chunksize entries."""
+    start, nentries, nvalues = time.time(), 0, 0
+    for b, entries in iterbibfiles(bibfiles, jobs):
         print(b.filepath)
-        conn.execute('INSERT INTO file (name, size, mtime, priority)'
-            'VALUES (?, ?, ?, ?)', (b.filename, b.size, b.mtime, b.priority))
-        for bibkey, (entrytype, fields) in b.iterentries():
-            conn.execute('INSERT INTO entry (filename, bibkey, refid) VALUES (?, ?, ?)',
-                (b.filename, bibkey, fields.get('glottolog_ref_id')))
-            fields = itertools.chain([('ENTRYTYPE', entrytype)], fields.iteritems())
-            conn.executemany('INSERT INTO value '
+        conn.execute('INSERT INTO file (name, size, mtime, digest, priority)'
+            'VALUES (?, ?, ?, ?, ?)', (b.filename, b.size, b.mtime, b.digest, b.priority))
+        entries = iter(entries)
+        while True:
+            chunk = list(itertools.islice(entries, chunksize))
+            if not chunk:
+                break
+            if packed:
+                rows = ((b.filename, bibkey, fields.get('glottolog_ref_id'), b.priority,
+                    packfields(entrytype, fields)) for bibkey, (entrytype, fields) in chunk)
+            else:
+                rows = ((b.filename, bibkey, fields.get('glottolog_ref_id'), None, None)
+                    for bibkey, (entrytype, fields) in chunk)
+            nentries += conn.executemany('INSERT INTO entry '
+                '(filename, bibkey, refid, priority, fields) VALUES (?, ?, ?, ?, ?)',
+                rows).rowcount
+            nvalues += conn.executemany('INSERT INTO value '
                 '(filename, bibkey, field, value) VALUES (?, ?, ?, ?)',
-                ((b.filename, bibkey, field, value) for field, value in fields))
+                ((b.filename, bibkey, field, value)
+                for bibkey, (entrytype, fields) in chunk
+                for field, value in itertools.chain([('ENTRYTYPE', entrytype)], fields.iteritems()))).rowcount
+    duration = time.time() - start
+    print('%d entries, %d values in %.1f sec (%d rows/sec)' % (nentries, nvalues,
+        duration, (nentries + nvalues) / duration if duration else 0))
+
+
+def reimport_bibfiles(conn, bibfiles, jobs=1):
+    """Replace the file/entry/value rows of changed bibfiles, keep the others."""
+    packed = ispacked(conn)
+    added, removed, changed = changed_bibfiles(conn, bibfiles)
+    for filename in removed + changed:
+        print('delete %s' % filename)
+        for table, col in [('value', 'filename'), ('entry', 'filename'),
+                           ('field', 'filename'), ('titleword', 'filename'),
+                           ('file', 'name')]:
+            conn.execute('DELETE FROM %s WHERE %s = ?' % (table, col), (filename,))
+    reload = set(added + changed)
+    import_bibfiles(conn, [b for b in bibfiles if b.filename in reload],
+        packed=packed, jobs=jobs)
+
+
+def packfields(entrytype, fields):
+    fields = dict(fields, ENTRYTYPE=entrytype)
+    return json.dumps(fields, separators=(',', ':'))
+
+
+def packedgrp(rows, overrides):
+    """Return grp from (filename, bibkey, priority, fields) rows of the packed layout.
+
+    Same order as the value table join: field, priority (descending), filename, bibkey.
+    """
+    values = collections.defaultdict(list)
+    for filename, bibkey, priority, fields in rows:
+        for field, value in json.loads(fields).iteritems():
+            prio = overrides.get((filename, field), priority)
+            values[field].append((-prio, filename, bibkey, value))
+    return [(field, [(vl, fn, bk) for p, fn, bk, vl in sorted(values[field])])
+        for field in sorted(values)]
+
+
+def ispacked(conn):
+    """Was the db built with packed=True?"""
+    row = conn.execute('SELECT fields IS NOT NULL FROM entry LIMIT 1').fetchone()
+    return bool(row and row[0])
+
+
+def fieldpriorities(conn):
+    return {(filename, field): priority for filename, field, priority
+        in conn.execute('SELECT filename, field, priority FROM field')}
+
+
+def iterbibfiles(bibfiles, jobs=1):
+    """Yield (bibfile, entries) pairs in order, parse in parallel if jobs != 1."""
+    if jobs == 1:
+        for b in bibfiles:
+            yield b, b.iterentries()
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for b, entries in itertools.izip(bibfiles, pool.imap(_parse_bibfile, bibfiles)):
+            yield b, entries
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parse_bibfile(bibfile):
+    return list(bibfile.iterentries())
 
 
 def update_priorities(conn, bibfiles):
@@ -385,26 +600,52 @@ def update_priorities(conn, bibfiles):
     for b in bibfiles:
         conn.execute('UPDATE file SET priority = ? WHERE NAME = ?',
             (b.priority, b.filename))
+        conn.execute('UPDATE entry SET priority = ? WHERE filename = ? '
+            'AND fields IS NOT NULL', (b.priority, b.filename))
     print('\n'.join('%d\t%s' % pn for pn in conn.execute(
         'SELECT priority, name FROM file ORDER BY priority DESC, name')))
 
 
 def compare_bibfiles(conn, bibfiles, verbose=False):
-    ondisk = collections.OrderedDict((b.filename, (b.size, str(b.mtime)))
-        for b in bibfiles)
-    indb = collections.OrderedDict((name, (size, mtime))
-        for name, size, mtime in
-        conn.execute('SELECT name, size, mtime FROM file ORDER BY name'))
-    if dict(ondisk) == dict(indb):
+    added, removed, changed = changed_bibfiles(conn, bibfiles)
+    if not (added or removed or changed):
         return True
     if verbose:
-        print('missing in db: %s' % [o for o in ondisk if o not in indb])
-        print('missing on disk: %s' % [i for i in indb if i not in ondisk])
-        print('differing in size/mtime: %s' % [o for o in ondisk
-            if o in indb and ondisk[o] != indb[o]])
+        print('missing in db: %s' % added)
+        print('missing on disk: %s' % removed)
+        print('differing in content: %s' % changed)
     return False
 
 
+def changed_bibfiles(conn, bibfiles):
+    """Return filenames missing in db, missing on disk, differing in content.
+
+    Files with the same size and mtime as in the db are taken as unchanged
+    without hashing them. If only the mtime differs but the digest is the
+    same (touch, git checkout), the new mtime is stored for the next check.
+    """
+    ondisk = collections.OrderedDict((b.filename, b) for b in bibfiles)
+    indb = collections.OrderedDict((name, (size, mtime, digest))
+        for name, size, mtime, digest in
+        conn.execute('SELECT name, size, mtime, digest FROM file ORDER BY name'))
+    added = [o for o in ondisk if o not in indb]
+    removed = [i for i in indb if i not in ondisk]
+    changed = []
+    for filename, b in ondisk.iteritems():
+        if filename not in indb:
+            continue
+        size, mtime, digest = indb[filename]
+        if b.size != size:
+            changed.append(filename)
+        elif str(b.mtime) != mtime:
+            if b.digest != digest:
+                changed.append(filename)
+            else:
+                conn.execute('UPDATE file SET mtime = ? WHERE name = ?',
+                    (b.mtime, filename))
+    return added, removed, changed
+
+
 def allid(conn):
     result, = conn.execute('SELECT NOT EXISTS (SELECT 1 FROM entry '
         'WHERE id IS NULL)').fetchone()
@@ -436,10 +677,11 @@ def fieldstats(conn, with_files=False):
             'FROM value GROUP BY field ORDER BY n DESC, field')))
 
 
-def windowed_entries(conn, chunksize):
+def windowed_entries(conn, chunksize, unhashed=False):
+    where = ' AND rarewords IS NULL' if unhashed else ''
     for filename, in conn.execute('SELECT name FROM file ORDER BY name'):
-        cursor = conn.execute('SELECT bibkey FROM entry WHERE filename = ? '
-            'ORDER BY bibkey', (filename,))
+        cursor = conn.execute('SELECT bibkey FROM entry WHERE filename = ?%s '
+            'ORDER BY bibkey' % where, (filename,))
         while True:
             bibkeys = cursor.fetchmany(chunksize)
             if not bibkeys:
@@ -458,28 +700,147 @@ def hashfields(conn, filename, bibkey):
     return tuple(fields.get(f) for f in ('author', 'editor', 'year', 'title'))
 
 
-def generate_hashes(conn):
-    from _libmonster import wrds, keyid
+def generate_hashes(conn, incremental=False, jobs=1, batchsize=10000):
+    from _libmonster import rarewords
 
-    words = collections.Counter()
-    cursor = conn.execute('SELECT value FROM value WHERE field = ?', ('title',))
-    while True:
-        rows = cursor.fetchmany(10000)
-        if not rows:
-            break
-        for title, in rows:
-            words.update(wrds(title))
+    if not incremental:
+        conn.execute('DELETE FROM titleword')
+    count_titlewords(conn)
+    words = Vocabulary.fromcounts(conn.execute('SELECT word, sum(count) '
+        'FROM titleword GROUP BY word ORDER BY word'))
     # TODO: consider dropping stop words/hapaxes from freq. distribution
-    print('%d title words (from %d tokens)' % (len(words), sum(words.itervalues())))
+    print('%d title words (from %d tokens)' % (len(words), words.total()))
+
+    if incremental:
+        previous = dict(conn.execute('SELECT word, count FROM wordfreq'))
+        delta = {w for w in set(words).union(previous) if words.get(w) != previous.get(w)}
+        cursor = conn.execute('SELECT filename, bibkey, hashwords, rarewords FROM entry '
+            "WHERE hashwords != '' AND rarewords IS NOT NULL")
+        stale = [(filename, bibkey) for filename, bibkey, types, rare in cursor
+            if not delta.isdisjoint(types.split())
+            and ' '.join(rarewords(types.split(), words)) != rare]
+        conn.executemany('UPDATE entry SET rarewords = NULL '
+            'WHERE filename = ? AND bibkey = ?', stale)
+        print('%d title words with changed frequency, %d entries with changed rare words'
+            % (len(delta), len(stale)))
+    else:
+        conn.execute('UPDATE entry SET rarewords = NULL')
+
+    updates, nhashed = [], 0
+    for filename, hashes in iterhashes(conn, words, jobs):
+        updates.extend((hash, types, rare, filename, bibkey)
+            for bibkey, hash, types, rare in hashes)
+        if len(updates) >= batchsize:
+            nhashed += update_hashes(conn, updates)
+            updates = []
+    nhashed += update_hashes(conn, updates)
+    print('%d entries hashed' % nhashed)
+
+    save_vocabulary(conn, words)
+
+
+def save_vocabulary(conn, vocabulary):
+    """Replace the wordfreq rows with the words of vocabulary (non-zero counts)."""
+    conn.execute('DELETE FROM wordfreq')
+    conn.executemany('INSERT INTO wordfreq (id, word, count) VALUES (?, ?, ?)',
+        ((i, w, n) for i, (w, n) in enumerate(itertools.izip(vocabulary.words, vocabulary.counts)) if n))
+
+
+def load_vocabulary(conn):
+    """Return the Vocabulary of the title word frequencies of the current hashes."""
+    return Vocabulary.fromcounts(conn.execute('SELECT word, count FROM wordfreq ORDER BY id'))
+
+
+def update_hashes(conn, updates):
+    if not updates:
+        return 0
+    return conn.executemany('UPDATE entry SET hash = ?, hashwords = ?, rarewords = ? '
+        'WHERE filename = ? AND bibkey = ?', updates).rowcount
+
+
+def count_titlewords(conn):
+    """Count title words of the bibfiles that have no titleword rows yet.
+
+    Also store the title word types of their entries as hashwords, so
+    the hashing does not tokenize the titles again (NULL if no title).
+    """
+    from _libmonster import wrds, keyid_types
+
+    filenames = conn.execute('SELECT name FROM file WHERE NOT EXISTS '
+        '(SELECT 1 FROM titleword WHERE filename = name) ORDER BY name').fetchall()
+    for filename, in filenames:
+        words, types = collections.Counter(), []
+        cursor = conn.execute('SELECT bibkey, value FROM value '
+            'WHERE filename = ? AND field = ?', (filename, 'title'))
+        for bibkey, title in cursor:
+            tks = wrds(title)
+            words.update(tks)
+            types.append((' '.join(keyid_types(tks)), filename, bibkey))
+        conn.executemany('INSERT INTO titleword (filename, word, count) '
+            'VALUES (?, ?, ?)', ((filename, w, n) for w, n in words.iteritems()))
+        conn.execute('UPDATE entry SET hashwords = NULL WHERE filename = ?', (filename,))
+        conn.executemany('UPDATE entry SET hashwords = ? '
+            'WHERE filename = ? AND bibkey = ?', types)
+
+
+def iterhashes(conn, words, jobs=1, chunksize=500):
+    """Yield (filename, [(bibkey, keyid, types, rarewords), ...]) windows of unhashed entries.
+
+    Hash in parallel worker processes if jobs != 1.
+    """
+    windows = iterfields(conn, chunksize)
+    if jobs == 1:
+        for filename, entries in windows:
+            yield keyid_window(filename, entries, words)
+        return
+    # read from the db in this thread, keep a bounded number of windows in flight
+    pool = multiprocessing.Pool(jobs, _init_keyid, (words,))
+    try:
+        pending = collections.deque()
+        maxpending = 4 * (jobs or multiprocessing.cpu_count())
+        for window in windows:
+            pending.append(pool.apply_async(_keyid_window, window))
+            if len(pending) >= maxpending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iterfields(conn, chunksize, get_entry=operator.itemgetter(0, 1)):
+    """Yield (filename, [(bibkey, hashwords, fields), ...]) windows of unhashed entries."""
+    for filename, first, last in windowed_entries(conn, chunksize, unhashed=True):
+        rows = conn.execute('SELECT v.bibkey, e.hashwords, v.field, v.value FROM entry AS e '
+            'JOIN value AS v ON e.filename = v.filename AND e.bibkey = v.bibkey '
+            'WHERE e.filename = ? AND e.bibkey BETWEEN ? AND ? AND e.rarewords IS NULL '
+            'AND v.field != ? ORDER BY v.bibkey', (filename, first, last, 'ENTRYTYPE'))
+        yield filename, [(bibkey, hashwords, {k: v for b, h, k, v in grp})
+            for (bibkey, hashwords), grp in itertools.groupby(rows, get_entry)]
+
+
+def keyid_window(filename, entries, words):
+    from _libmonster import keyids
+
+    result = []
+    hashes = keyids((fields for _, _, fields in entries), words,
+        titlewords=(None if types is None else types.split() for _, types, _ in entries))
+    for (bibkey, _, _), (hash, types, rare) in zip(entries, hashes):
+        if types is None:  # independent of title word frequencies
+            result.append((bibkey, hash, None, ''))
+        else:
+            result.append((bibkey, hash, ' '.join(types), ' '.join(rare)))
+    return filename, result
+
 
-    get_bibkey = operator.itemgetter(0)
-    for filename, first, last in windowed_entries(conn, 500):
-        rows = conn.execute('SELECT bibkey, field, value FROM value '
-            'WHERE filename = ? AND bibkey BETWEEN ? AND ? '
-            'AND field != ? ORDER BY bibkey', (filename, first, last, 'ENTRYTYPE'))
-        conn.executemany('UPDATE entry SET hash = ? WHERE filename = ? AND bibkey = ?',
-            ((keyid({k: v for b, k, v in grp}, words), filename, bibkey)
-            for bibkey, grp in itertools.groupby(rows, get_bibkey)))
+def _init_keyid(words):
+    global _keyid_words
+    _keyid_words = words
+
+
+def _keyid_window(filename, entries):
+    return keyid_window(filename, entries, _keyid_words)
 
 
 def hashstats(conn):
@@ -515,6 +876,77 @@ def hashidstats(conn):
         'GROUP BY id_nhash ORDER BY n desc')))
 
 
+def windowrows(conn, chunksize, packed=False):
+    """Yield a list of (id, hash, ...) rows for each window of chunksize ids."""
+    if packed:
+        query = ('SELECT id, hash, filename, bibkey, priority, fields '
+            'FROM entry WHERE id BETWEEN ? AND ? ORDER BY id')
+    else:
+        query = ('SELECT e.id, e.hash, v.field, v.value, v.filename, v.bibkey '
+            'FROM entry AS e '
+            'JOIN file AS f ON e.filename = f.name '
+            'JOIN value AS v ON e.filename = v.filename AND e.bibkey = v.bibkey '
+            'LEFT JOIN field AS d ON v.filename = d.filename AND v.field = d.field '
+            'WHERE e.id BETWEEN ? AND ? '
+            'ORDER BY e.id, v.field, coalesce(d.priority, f.priority) DESC, v.filename, v.bibkey')
+    for first, last in windowed(conn, 'id', chunksize):
+        yield conn.execute(query, (first, last)).fetchall()
+
+
+def itergrps(windows, overrides=None,
+             get_id_hash=operator.itemgetter(0, 1), get_field=operator.itemgetter(2)):
+    """Yield ((id, hash), grp) pairs from windowrows (overrides: packed layout)."""
+    for rows in windows:
+        for id_hash, grp in itertools.groupby(rows, get_id_hash):
+            if overrides is not None:
+                yield id_hash, packedgrp((row[2:] for row in grp), overrides)
+            else:
+                yield id_hash, [(field, [(vl, fn, bk) for id, hs, fd, vl, fn, bk in g])
+                    for field, g in itertools.groupby(grp, get_field)]
+
+
+def prefetched(connect, iterwindows, size):
+    """Run iterwindows(conn) in a background thread, yield its items from a bounded queue."""
+    queue = Queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            with connect() as conn:
+                for rows in iterwindows(conn):
+                    if not put((True, rows)):
+                        return
+        except Exception:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if ok:
+                yield item
+            elif item is None:
+                break
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        stop.set()
+        thread.join()
+
+
 def windowed(conn, col, chunksize):
     query = 'SELECT DISTINCT %(col)s FROM entry ORDER BY %(col)s' % {'col': col}
     cursor = conn.execute(query)
@@ -527,9 +959,31 @@ def windowed(conn, col, chunksize):
         yield first, last
 
 
-def assign_ids(conn, verbose=False):
-    merged_entry, entrygrp = Database._merged_entry, Database._entrygrp
+class MergedEntries(dict):
+    """Memoized raw merged entries by refid (old grouping) or hash (current grouping)."""
+
+    def __init__(self, conn):
+        super(MergedEntries, self).__init__()
+        self.conn = conn
 
+    def load(self, keys, chunksize=500):
+        """Fetch the groups of all keys not cached yet with set-based queries."""
+        missing = [k for k in unique(keys) if k not in self]
+        refids = [k for k in missing if isinstance(k, int)]
+        hashes = [k for k in missing if not isinstance(k, int)]
+        for col, keys in [('refid', refids), ('hash', hashes)]:
+            for i in range(0, len(keys), chunksize):
+                for key, grp in Database._entrygrps(self.conn, col, keys[i:i + chunksize]):
+                    self[key] = Database._merged_entry(grp, raw=True)
+
+    def __missing__(self, key):
+        self.load([key])
+        if key not in self:
+            raise KeyError(key)
+        return self[key]
+
+
+def assign_ids(conn, verbose=False):
     allhash, = conn.execute('SELECT NOT EXISTS (SELECT 1 FROM entry '
         'WHERE hash IS NULL)').fetchone()
     assert allhash
@@ -541,12 +995,15 @@ def assign_ids(conn, verbose=False):
     cursor = conn.execute('SELECT refid, hash, filename, bibkey FROM entry AS e '
         'WHERE EXISTS (SELECT 1 FROM entry WHERE refid = e.refid AND hash != e.hash) '
         'ORDER BY refid, hash, filename, bibkey')
-    for refid, group in group_first(cursor):
-        old = merged_entry(entrygrp(conn, refid), raw=True)
+    groups = list(group_first(cursor))
+    merged_entries = MergedEntries(conn)
+    merged_entries.load(k for refid, group in groups
+        for k in itertools.chain([refid], (hs for ri, hs, fn, bk in group)))
+    for refid, group in groups:
+        old = merged_entries[refid]
         nsplit += len(group)
-        cand = [(hs, merged_entry(entrygrp(conn, hs), raw=True))
-            for hs in unique(hs for ri, hs, fn, bk in group)]
-        new = min(cand, key=lambda (hs, fields): distance(old, fields))[0]
+        cand = [(hs, merged_entries[hs]) for hs in unique(hs for ri, hs, fn, bk in group)]
+        new = closest(old, cand)
         separated = conn.execute('UPDATE entry SET srefid = NULL WHERE refid = ? AND hash != ?',
             (refid, new)).rowcount
         if verbose:
@@ -567,12 +1024,14 @@ def assign_ids(conn, verbose=False):
     cursor = conn.execute('SELECT hash, srefid, filename, bibkey FROM entry AS e '
         'WHERE EXISTS (SELECT 1 FROM entry WHERE hash = e.hash AND srefid != e.srefid) '
         'ORDER BY hash, srefid DESC, filename, bibkey')
-    for hash, group in group_first(cursor):
-        new = merged_entry(entrygrp(conn, hash), raw=True)
+    groups = list(group_first(cursor))
+    merged_entries.load(k for hash, group in groups
+        for k in itertools.chain([hash], (ri for hs, ri, fn, bk in group)))
+    for hash, group in groups:
+        new = merged_entries[hash]
         nmerge += len(group)
-        cand = [(ri, merged_entry(entrygrp(conn, ri), raw=True))
-            for ri in unique(ri for hs, ri, fn, bk in group)]
-        old = min(cand, key=lambda (ri, fields): distance(new, fields))[0]
+        cand = [(ri, merged_entries[ri]) for ri in unique(ri for hs, ri, fn, bk in group)]
+        old = closest(new, cand)
         merged = conn.execute('UPDATE entry SET id = ? WHERE hash = ? AND srefid != ?',
             (old, hash, old)).rowcount
         if verbose:
@@ -625,8 +1084,41 @@ def unique(iterable):
             yield item
 
 
-def distance(left, right, weight={'author': 3, 'year': 3, 'title': 3, 'ENTRYTYPE': 2}):
-    """Simple measure of the difference between two bibtex-field dicts."""
+def sequencematcher_ratio(a, b):
+    """Similarity of two strings (0..1) with difflib (Ratcliff/Obershelp)."""
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def lcs_ratio(a, b):
+    """Similarity of two strings (0..1): 2 * longest common subsequence / total length.
+
+    Uses the bit-parallel LCS length of Hyyro (2004): one python (long) integer
+    holds one bit per character of a, each character of b costs a few integer ops.
+    """
+    total = len(a) + len(b)
+    if not total:
+        return 1.0
+    if len(a) < len(b):
+        a, b = b, a
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | 1 << i
+    full = v = (1 << len(a)) - 1
+    for c in b:
+        u = v & masks.get(c, 0)
+        v = (v + u) | (v - u)
+    lcs = len(a) - bin(v & full).count('1')
+    return 2.0 * lcs / total
+
+
+def distance(left, right, weight={'author': 3, 'year': 3, 'title': 3, 'ENTRYTYPE': 2},
+             ratio=lcs_ratio, maxlen=None, cutoff=None):
+    """Simple measure of the difference between two bibtex-field dicts.
+
+    ratio: string similarity function, maxlen: compare only the start of longer
+    values, cutoff: stop early (returning a value above cutoff) as soon as the
+    result cannot be below cutoff any more.
+    """
     if not (left or right):
         return 0.0
 
@@ -635,9 +1127,37 @@ def distance(left, right, weight={'author': 3, 'year': 3, 'title': 3, 'ENTRYTYPE
         return 1.0
 
     weights = {k: weight.get(k, 1) for k in keys}
-    ratios = (w * difflib.SequenceMatcher(None, left[k], right[k]).ratio()
-        for k, w in weights.iteritems())
-    return 1 - (sum(ratios) / sum(weights.itervalues()))
+    total = float(sum(weights.itervalues()))
+    if maxlen is None:
+        values = {k: (left[k], right[k]) for k in keys}
+    else:
+        values = {k: (left[k][:maxlen], right[k][:maxlen]) for k in keys}
+    if cutoff is None:
+        ratios = (w * ratio(*values[k]) for k, w in weights.iteritems())
+        return 1 - (sum(ratios) / total)
+
+    # upper bound of each ratio from the value lengths
+    bounds = {k: 2.0 * min(len(l), len(r)) / (len(l) + len(r)) if l or r else 1.0
+        for k, (l, r) in values.iteritems()}
+    remaining = sum(w * bounds[k] for k, w in weights.iteritems())
+    result = 0.0
+    for k, w in weights.iteritems():
+        lower = 1 - ((result + remaining) / total)
+        if lower > cutoff + 1e-9:
+            return lower
+        remaining -= w * bounds[k]
+        result += w * ratio(*values[k])
+    return 1 - (result / total)
+
+
+def closest(target, candidates, **kwargs):
+    """Return the key of the first (key, fields) candidate with minimal distance to target."""
+    best = bestkey = None
+    for key, fields in candidates:
+        d = distance(target, fields, cutoff=best, **kwargs)
+        if best is None or d < best:
+            best, bestkey = d, key
+    return bestkey
 
 
 def _test_merge():
@@ -678,6 +1198,109 @@ def _test_merge():
         for f1, f2, n in engine.execute(query)))
 
 
+def _test_jobs(jobs=None, bibfiles=None, filename='_bibfiles_jobs.sqlite3'):
+    """Import with one and with jobs worker processes, assert identical rows, compare speed."""
+    bibfiles = Database._get_bibfiles(bibfiles)
+    timings, contents = [], []
+    for j in (1, jobs):
+        if os.path.exists(filename):
+            os.remove(filename)
+        with contextlib.closing(sqlite3.connect(filename)) as conn:
+            create_tables(conn)
+            start = time.time()
+            with conn:
+                import_bibfiles(conn, bibfiles, jobs=j)
+            timings.append((j, time.time() - start))
+            contents.append({table: sorted(conn.execute('SELECT * FROM %s' % table))
+                for table in ('file', 'field', 'entry', 'value', 'titleword')})
+    os.remove(filename)
+    assert contents[0] == contents[1]
+    print('\n'.join('jobs=%r: %.1f sec' % jt for jt in timings))
+
+
+def _test_packed(bibfiles=None):
+    """Build the db with both layouts into a temporary directory, assert identical merged(), compare size and speed."""
+    bibfiles = Database._get_bibfiles(bibfiles)
+    directory = tempfile.mkdtemp(prefix='_bibfiles_db')
+    try:
+        results = []
+        for packed in (False, True):
+            filename = os.path.join(directory, 'packed.sqlite3' if packed else 'unpacked.sqlite3')
+            db = Database.from_bibfiles(bibfiles, filename, rebuild=True, packed=packed)
+            start = time.time()
+            results.append(list(db.merged()))
+            duration = time.time() - start
+            print('packed=%r: %d bytes, %d merged entries in %.1f sec' % (packed,
+                os.path.getsize(filename), len(results[-1]), duration))
+    finally:
+        shutil.rmtree(directory)
+    assert results[0] == results[1]
+
+
+def _test_merged(filename=None, chunksize=100, prefetch=2):
+    """Assert identical merged() without and with prefetching, compare speed."""
+    db = Database(filename)
+    results = []
+    for p in (0, prefetch):
+        start = time.time()
+        results.append(list(db.merged(chunksize, p)))
+        duration = time.time() - start
+        n = len(results[-1])
+        print('prefetch=%d: %d merged entries in %.1f sec (%d/sec)' % (p, n,
+            duration, n / duration))
+    assert results[0] == results[1]
+
+
+def _test_distance(filename=None, maxlen=None):
+    """Replay the split/merge candidate choices of the db with both ratio functions.
+
+    Assert that closest makes the same decisions as min(distance) for each
+    ratio, print and return the decisions where lcs_ratio differs from difflib.
+    """
+    with Database(filename).connect() as conn:
+        merged_entries = MergedEntries(conn)
+        problems = []
+        for query in ['SELECT refid, hash FROM entry AS e '
+            'WHERE EXISTS (SELECT 1 FROM entry WHERE refid = e.refid AND hash != e.hash) '
+            'ORDER BY refid, hash, filename, bibkey',
+            'SELECT hash, srefid FROM entry AS e '
+            'WHERE EXISTS (SELECT 1 FROM entry WHERE hash = e.hash AND srefid != e.srefid) '
+            'ORDER BY hash, srefid DESC, filename, bibkey']:
+            groups = list(group_first(conn.execute(query)))
+            merged_entries.load(k for key, group in groups
+                for k in itertools.chain([key], (c for _, c in group)))
+            problems.extend((merged_entries[key],
+                [(c, merged_entries[c]) for c in unique(c for _, c in group)])
+                for key, group in groups)
+
+    def argmin(target, cand, ratio):
+        return min(cand, key=lambda (k, fields): distance(target, fields,
+            ratio=ratio, maxlen=maxlen))[0]
+
+    decisions = {}
+    for name, ratio in [('difflib', sequencematcher_ratio), ('lcs', lcs_ratio)]:
+        start = time.time()
+        expected = [argmin(target, cand, ratio) for target, cand in problems]
+        middle = time.time()
+        result = [closest(target, cand, ratio=ratio, maxlen=maxlen) for target, cand in problems]
+        end = time.time()
+        assert result == expected  # the cutoff is exact
+        decisions[name] = result
+        print('%s: min(distance) %.3f sec, closest %.3f sec, %d decisions' % (name,
+            middle - start, end - middle, len(result)))
+
+    # difflib matches a common subsequence, so its ratio is never above lcs_ratio,
+    # differences are decisions for the candidate with the longer common subsequence
+    differ = [(target, cand, d, l) for (target, cand), d, l
+        in zip(problems, decisions['difflib'], decisions['lcs']) if d != l]
+    for target, cand, d, l in differ:
+        fields = dict(cand)
+        print('%r: difflib %r (%.3f), lcs %r (%.3f)' % (target.get('title'),
+            d, distance(target, fields[d], ratio=lcs_ratio, maxlen=maxlen),
+            l, distance(target, fields[l], ratio=lcs_ratio, maxlen=maxlen)))
+    print('%d of %d decisions differ from difflib' % (len(differ), len(problems)))
+    return differ
+
 if __name__ == '__main__':
     d = Database.from_bibfiles()
     #d.recompute(hashes=False)
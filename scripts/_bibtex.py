@@ -2,24 +2,32 @@
 
 # TODO: make check fail on non-whitespace between entries (bibtex 'comments')
 
+import os
 import io
 import re
 import mmap
+import heapq
+import shutil
+import hashlib
+import tempfile
+import cPickle as pickle
 import contextlib
 import collections
 
-from pybtex.database.input.bibtex import BibTeXEntryIterator, Parser, UndefinedMacro
+from pybtex.database.input.bibtex import BibTeXEntryIterator, Parser, UndefinedMacro, SkipEntry, month_names
 from pybtex.scanner import PybtexSyntaxError
 from pybtex.exceptions import PybtexError
 from pybtex.textutils import whitespace_re
 from pybtex.bibtex.utils import split_name_list
 from pybtex.database import Person
 
-from _bibtex_escaping import u_escape, u_unescape, latex_to_utf8
+from _bibtex_escaping import u_escape, u_unescape, latex_decoder
+from _bibtex_ordering import Ordering
 
 __all__ = [
-    'load', 'iterentries', 'names',
-    'save', 'dump',
+    'load', 'iterentries', 'scanentries', 'index', 'iterentries_at',
+    'names', 'digest',
+    'save', 'dump', 'rewrite',
     'check',
 ]
 
@@ -31,6 +39,12 @@ FIELDORDER = [
 
 VERBATIM = {'doi', 'eprint', 'file', 'url', 'pdf', 'fn', 'fnnote'}
 
+MAXSIZE = 2 ** 26
+
+MEMOSIZE = 10000
+
+PARSER_VERSION = 3  # increment on every change of the iterentries/scanentries/index output (cached)
+
 
 @contextlib.contextmanager
 def memorymapped(filename, access=mmap.ACCESS_READ):
@@ -47,14 +61,25 @@ def memorymapped(filename, access=mmap.ACCESS_READ):
         fd.close()
 
 
-def load(filename, preserve_order=False, encoding=None, use_pybtex=True):
+def digest(filename, hashfunc=hashlib.sha1):
+    """Return the hexdigest of the file content (hashed from the mmap)."""
+    with memorymapped(filename) as source:
+        return hashfunc(source).hexdigest()
+
+
+def load(filename, preserve_order=False, encoding=None, use_pybtex=True, use_scanner=True):
     cls = collections.OrderedDict if preserve_order else dict
-    return cls(iterentries(filename, encoding, use_pybtex))
+    return cls(iterentries(filename, encoding, use_pybtex, use_scanner))
+
 
+def iterentries(filename, encoding=None, use_pybtex=True, use_scanner=True, spans=False, bibkeys=None):
+    """Yield (bibkey, (entrytype, fields)) or with spans ((start, end), (bibkey, ...)).
 
-def iterentries(filename, encoding=None, use_pybtex=True):
+    With bibkeys, only the entries with these keys are decoded and yielded.
+    @string and @preamble commands are not yielded (their macros are applied).
+    """
     if not use_pybtex:  # legacy code path for conversion/comparison
-        if encoding not in (None, 'ascii'):
+        if encoding not in (None, 'ascii') or spans or bibkeys is not None:
             raise NotImplementedError
         import _libmonster
         with memorymapped(filename) as source:
@@ -64,16 +89,144 @@ def iterentries(filename, encoding=None, use_pybtex=True):
         raise NotImplementedError
     else:
         with memorymapped(filename) as source:
+            macros = dict(month_names)
+            if spans or use_scanner:
+                entries = scanentries(source, spans=spans, macros=macros)
+            else:
+                entries = BibTeXEntryIterator(source, macros=macros)
             try:
-                for entrytype, (bibkey, fields) in BibTeXEntryIterator(source):
-                    fields = {name.decode(encoding).lower():
-                        whitespace_re.sub(' ', ''.join(values).decode(encoding).strip())
-                        for name, values in fields}
-                    yield bibkey.decode(encoding), (entrytype.decode(encoding), fields)
+                for entry in entries:
+                    if spans:
+                        span, entry = entry
+                    if entry[0].lower() in COMMANDS:
+                        continue
+                    entrytype, (bibkey, fields) = entry
+                    bibkey = bibkey.decode(encoding)
+                    if bibkeys is not None and bibkey not in bibkeys:
+                        continue
+                    entry = bibkey, (entrytype.decode(encoding), decodefields(fields, encoding))
+                    yield (span, entry) if spans else entry
             except PybtexSyntaxError as e:
                 debug_pybtex(source, e)
 
 
+def decodefields(fields, encoding):
+    return {name.decode(encoding).lower():
+        whitespace_re.sub(' ', ''.join(values).decode(encoding).strip())
+        for name, values in fields}
+
+
+def index(filename, encoding=None):
+    """Return a bibkey -> (offset, length) dict with the byte spans of the entries
+    and the list of the (offset, length) spans of the @string commands."""
+    if encoding is None:
+        raise NotImplementedError
+    entries, strings = {}, []
+    with memorymapped(filename) as source:
+        try:
+            for (start, end), (entrytype, body) in scanentries(source, spans=True, macros=dict(month_names)):
+                entrytype = entrytype.lower()
+                if entrytype == 'string':
+                    strings.append((start, end - start))
+                elif entrytype not in COMMANDS:
+                    entries[body[0].decode(encoding)] = start, end - start
+        except PybtexSyntaxError as e:
+            debug_pybtex(source, e)
+    return entries, strings
+
+
+def iterentries_at(filename, offsets, encoding=None, strings=()):
+    """Yield (bibkey, (entrytype, fields)) parsing only the entries at (offset, length) positions.
+
+    strings are the spans of the @string commands of the file (see index), the
+    macros of those before an entry are defined for it (as in iterentries).
+    """
+    if encoding is None:
+        raise NotImplementedError
+    strings = sorted(strings)
+    with memorymapped(filename) as source:
+        macros, defined = dict(month_names), 0
+        for offset, length in offsets:
+            if defined and strings[defined - 1][0] > offset:  # offsets not ascending
+                macros, defined = dict(month_names), 0
+            while defined < len(strings) and strings[defined][0] < offset:
+                start, size = strings[defined]
+                for _ in scanentries(source[start:start + size] + '\n', macros=macros):
+                    pass
+                defined += 1
+            text = source[offset:offset + length] + '\n'  # terminated as in the file
+            for entrytype, (bibkey, fields) in scanentries(text, macros=macros):
+                yield bibkey.decode(encoding), (entrytype.decode(encoding), decodefields(fields, encoding))
+
+
+CANONICAL = re.compile(r'''@(?P<entrytype>[a-zA-Z_][\w:.+-]*)\{(?P<bibkey>[^\s,}]+)
+    (?:,\n\}|(?P<fields>(?:,\n[ ]{4}[a-zA-Z_][\w:.+-]*[ ]=[ ]\{[^\n]*\})+)\n\})\n''', re.VERBOSE)
+
+COMMANDS = {'comment', 'string', 'preamble'}  # never scanned as entries (left to pybtex)
+
+CANONICAL_FIELD = re.compile(r',\n[ ]{4}([a-zA-Z_][\w:.+-]*) = \{([^\n]*)\}')
+
+INNERMOST_BRACES = re.compile(r'\{[^{}]*\}')
+
+
+def scanentries(source, spans=False, **kwargs):
+    """Yield (entrytype, (bibkey, fields)) like BibTeXEntryIterator from the buffer.
+
+    Entries in the layout written by dump() are tokenized by regex directly from
+    the buffer, everything else is delegated to pybtex (kwargs are passed to its
+    BibTeXEntryIterator). With spans, yield ((start, end), entry) pairs, where
+    source[start:end] is the entry from its @ up to its closing delimiter.
+    """
+    match, iterfields, find = CANONICAL.match, CANONICAL_FIELD.findall, source.find
+    fallback = None
+    pos = 0
+    lineno, lineno_pos = 1, 0  # line number at lineno_pos (counted incrementally)
+    while True:
+        start = find('@', pos)
+        if start == -1:
+            return
+        m = match(source, start)
+        if m is not None and m.group('entrytype').lower() not in COMMANDS:
+            entrytype, bibkey, fields = m.groups()
+            if fields is None:
+                entry = entrytype, (bibkey, [])
+            else:
+                fields = iterfields(fields)
+                if all(balanced(value) for _, value in fields):
+                    entry = entrytype, (bibkey, [(name, [value]) for name, value in fields])
+                else:
+                    entry = None
+            if entry is not None:
+                pos = m.end()
+                yield ((start, pos - 1), entry) if spans else entry
+                continue
+        if fallback is None:
+            fallback = BibTeXEntryIterator(source, **kwargs)
+        fallback.pos = fallback.command_start = start
+        lineno += source[lineno_pos:start].count('\n')
+        fallback.lineno, lineno_pos = lineno, start
+        fallback.required([fallback.AT])
+        try:
+            entry = tuple(fallback.parse_command())
+        except PybtexSyntaxError as error:
+            fallback.handle_error(error)
+        except SkipEntry:
+            pass
+        else:
+            yield ((start, fallback.pos), entry) if spans else entry
+        pos = fallback.pos
+
+
+def balanced(value):
+    """Return True if the braced value is closed by its last brace (as in pybtex)."""
+    if '{' not in value and '}' not in value:
+        return True
+    while True:
+        value, n = INNERMOST_BRACES.subn('', value)
+        if not n:
+            return '{' not in value and '}' not in value
+
+
 def debug_pybtex(source, e):
     start, line, pos = e.error_context_info
     print('BIBTEX ERROR on line %d, last parsed lines:' % line)
@@ -102,17 +255,61 @@ class Name(collections.namedtuple('Name', 'prelast last given lineage')):
         return cls(prelast, last, given, lineage)
 
 
-def save(entries, filename, sortkey, encoding=None, errors='strict', use_pybtex=True, verbose=True):
+def save(entries, filename, sortkey, encoding=None, errors='strict', use_pybtex=True, verbose=True, maxsize=MAXSIZE):
     if encoding in (None, 'ascii', 'ascii+u_escape'):
         with open(filename, 'w') as fd:
-            dump(entries, fd, sortkey, encoding, errors, use_pybtex, verbose)
+            return dump(entries, fd, sortkey, encoding, errors, use_pybtex, verbose, maxsize=maxsize)
     else:
         assert errors == 'strict'
         with io.open(filename, 'w', encoding=encoding, errors=errors) as fd:
-            dump(entries, fd, sortkey, encoding, None, use_pybtex, verbose)
+            return dump(entries, fd, sortkey, encoding, None, use_pybtex, verbose, maxsize=maxsize)
+
+
+def rewrite(filename, replacements, encoding=None, errors='strict', use_pybtex=True, verbose=True):
+    """Replace entry blocks of the file, copying everything else unchanged.
+
+    replacements maps (start, end) spans from iterentries(spans=True) to
+    (bibkey, (entrytype, fields)) items, which are formatted as by dump().
+    The result is streamed into a temporary file that replaces filename.
+    Return the list of LatexDiagnostics (see formatter).
+    """
+    diagnostics = []
+    if encoding in (None, 'ascii', 'ascii+u_escape'):
+        format_entry = formatter(encoding, errors, use_pybtex, verbose, diagnostics=diagnostics)
+        encoding = 'ascii'
+    else:
+        assert errors == 'strict'
+        format_entry = formatter(encoding, None, use_pybtex, verbose, diagnostics=diagnostics)
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd = tempfile.NamedTemporaryFile(dir=directory, prefix=basename, suffix='.tmp', delete=False)
+    try:
+        with memorymapped(filename) as source, fd:
+            pos = 0
+            for start, end in sorted(replacements):
+                bibkey, (entrytype, fields) = replacements[start, end]
+                text = format_entry(bibkey, entrytype, fields)
+                if isinstance(text, unicode):
+                    text = text.encode(encoding)
+                assert text.endswith('}\n')
+                fd.write(source[pos:start])
+                fd.write(text[:-1])
+                pos = end
+            fd.write(source[pos:])
+        shutil.copymode(filename, fd.name)
+        os.rename(fd.name, filename)
+    except:
+        os.remove(fd.name)
+        raise
+    return diagnostics
+
 
+def dump(entries, fd, sortkey=None, encoding=None, errors='strict', use_pybtex=True, verbose=True, verbatim=VERBATIM, maxsize=MAXSIZE):
+    """Write entries (dict or iterable of (bibkey, (entrytype, fields)) pairs) to fd.
 
-def dump(entries, fd, sortkey=None, encoding=None, errors='strict', use_pybtex=True, verbose=True, verbatim=VERBATIM):
+    With sortkey, the formatted entries are sorted in runs of about maxsize
+    characters, spilling to temporary files and merging if there is more than one.
+    Return the list of LatexDiagnostics (see formatter).
+    """
     if sortkey is None:
         if isinstance(entries, collections.OrderedDict):
             items = entries.iteritems()
@@ -120,16 +317,48 @@ def dump(entries, fd, sortkey=None, encoding=None, errors='strict', use_pybtex=T
             raise ValueError('dump needs sortkey or ordered entries')
         else:
             items = entries
-    elif sortkey == 'bibkey':
-        items = ((bibkey, entries[bibkey]) for bibkey in
-            sorted(entries, key=lambda bibkey: bibkey.lower()))
-    elif sortkey == 'authorbibkey_colon':  # legacy order for hh.bib
-        def sortkey((bibkey, (entrytype, fields))):
-            return fields.get('author', '') + ':'.join(bibkey.split(':', 1)[::-1])
-        items = sorted(entries.iteritems(), key=sortkey)
+    elif sortkey in SORTKEYS:
+        items = entries.iteritems() if isinstance(entries, dict) else entries
+        key = SORTKEYS[sortkey]
     else:
         raise ValueError(sortkey)
-    """Reserved characters (* -> en-/decoded by latexcodec)
+    diagnostics = []
+    format_entry = formatter(encoding, errors, use_pybtex, verbose, verbatim, diagnostics)
+    if sortkey is None:
+        for bibkey, (entrytype, fields) in items:
+            fd.write(format_entry(bibkey, entrytype, fields))
+    else:
+        records = ((key(bibkey, fields), format_entry(bibkey, entrytype, fields))
+            for bibkey, (entrytype, fields) in items)
+        for text in externalsorted(records, maxsize):
+            fd.write(text)
+    return diagnostics
+
+
+def _sortkey_bibkey(bibkey, fields):
+    return bibkey.lower()
+
+
+def _sortkey_authorbibkey_colon(bibkey, fields):  # legacy order for hh.bib
+    return fields.get('author', '') + ':'.join(bibkey.split(':', 1)[::-1])
+
+
+SORTKEYS = {
+    'bibkey': _sortkey_bibkey,
+    'authorbibkey_colon': _sortkey_authorbibkey_colon,
+}
+
+
+LatexDiagnostic = collections.namedtuple('LatexDiagnostic', 'bibkey field value leftovers')
+
+
+def formatter(encoding=None, errors='strict', use_pybtex=True, verbose=True, verbatim=VERBATIM, diagnostics=None):
+    r"""Return a function formatting (bibkey, entrytype, fields) as BibTeX entry string.
+
+    Values with LaTeX left over after decoding to unicode are appended to the
+    diagnostics list (if given) as LatexDiagnostics (and printed if verbose).
+
+    Reserved characters (* -> en-/decoded by latexcodec)
     * #: \#
       $: \$
       %: \%
@@ -143,103 +372,232 @@ def dump(entries, fd, sortkey=None, encoding=None, errors='strict', use_pybtex=T
       <: \textless
       >: \textgreater
     """
+    sortedkeys = fieldorder.sortedkeys
     if not use_pybtex:  # legacy code path for conversion/comparison
         if encoding not in (None, 'ascii'):
             raise NotImplementedError
-        for bibkey, (entrytype, fields) in items:
-            fd.write('@%s{%s' % (entrytype, bibkey))
-            for k, v in fieldorder.itersorted(fields):
+        def format_entry(bibkey, entrytype, fields):
+            parts = ['@%s{%s' % (entrytype, bibkey)]
+            for k in sortedkeys(fields):
+                v = fields[k]
                 if k in verbatim:
                     v = v.strip().encode('ascii', errors)
                 else:
                     v = v.strip().encode('latex', errors).replace(r'\#', '#').replace(r'\&', r'&').replace(r'\_', '_')
-                fd.write(',\n    %s = {%s}' % (k, v))
-            fd.write('\n}\n' if fields else ',\n}\n')
+                parts.append(',\n    %s = {%s}' % (k, v))
+            parts.append('\n}\n' if fields else ',\n}\n')
+            return ''.join(parts)
     elif encoding is None:
         raise NotImplementedError
-    elif encoding == 'ascii+u_escape':
-        for bibkey, (entrytype, fields) in items:
-            fd.write('@%s{%s' % (entrytype, bibkey))
-            for k, v in fieldorder.itersorted(fields):
-                if k in verbatim:
-                    v = v.strip().encode('ascii')
-                else:
-                    v = u_escape(v).strip().encode('latex', errors).replace(r'\#', '#').replace(r'\\&', r'\&').replace(r'\_', '_')
-                fd.write(',\n    %s = {%s}' % (k, v))
-            fd.write('\n}\n' if fields else ',\n}\n')
-    elif encoding == 'ascii':
-        for bibkey, (entrytype, fields) in items:
-            fd.write('@%s{%s' % (entrytype, bibkey))
-            for k, v in fieldorder.itersorted(fields):
+    elif encoding in ('ascii', 'ascii+u_escape'):
+        encode = latex_encoder(u_escaped=encoding == 'ascii+u_escape', errors=errors)
+        def format_entry(bibkey, entrytype, fields):
+            parts = ['@%s{%s' % (entrytype, bibkey)]
+            for k in sortedkeys(fields):
+                v = fields[k]
                 if k in verbatim:
                     v = v.strip().encode('ascii')
                 else:
-                    v = v.strip().encode('latex', errors).replace(r'\#', '#').replace(r'\\&', r'\&').replace(r'\_', '_')
-                fd.write(',\n    %s = {%s}' % (k, v))
-            fd.write('\n}\n' if fields else ',\n}\n')
+                    v = encode(v)
+                parts.append(',\n    %s = {%s}' % (k, v))
+            parts.append('\n}\n' if fields else ',\n}\n')
+            return ''.join(parts)
     else:
         assert errors is None
-        for bibkey, (entrytype, fields) in items:
-            fd.write(u'@%s{%s' % (entrytype, bibkey))
-            for k, v in fieldorder.itersorted(fields):
+        decode = latex_decoder()
+        def format_entry(bibkey, entrytype, fields):
+            parts = [u'@%s{%s' % (entrytype, bibkey)]
+            for k in sortedkeys(fields):
+                v = fields[k]
                 if k in verbatim:
                     v = v.strip().decode('ascii')
                 elif isinstance(v, str):
-                    v = latex_to_utf8(v.strip(), verbose=verbose)
-                fd.write(u',\n    %s = {%s}' % (k, v))
-            fd.write(u'\n}\n' if fields else u',\n}\n')
+                    v, leftovers = decode(v.strip())
+                    if leftovers:
+                        if diagnostics is not None:
+                            diagnostics.append(LatexDiagnostic(bibkey, k, v, leftovers))
+                        if verbose:
+                            print(leftovers[:100])
+                parts.append(u',\n    %s = {%s}' % (k, v))
+            parts.append(u'\n}\n' if fields else u',\n}\n')
+            return u''.join(parts)
+    return format_entry
+
+
+def latex_encoder(u_escaped=False, errors='strict', memosize=MEMOSIZE,
+                  nonascii=re.compile(u'[^\x00-\x7f]'), ampersand=re.compile(r'(?<!\\)&')):
+    r"""Return a function encoding field values for the ascii dump branches.
+
+    Same result as (u_escape(v) if u_escaped else v).strip().encode('latex',
+    errors).replace(r'\#', '#').replace(r'\\&', r'\&').replace(r'\_', '_'):
+    for ASCII, latexcodec (pinned in requirements.txt, asserted in
+    _bibtex_escaping) only escapes #, & and _, which the replacements undo
+    except for ampersands not already preceded by a backslash. Other values
+    go through latexcodec, memoized (cleared when memosize is reached).
+    See _compare_latex_encoder.py for the check against the expression.
+    """
+    memo = {}
+
+    def encode(v):
+        if nonascii.search(v) is None:
+            v = v.strip().encode('ascii')
+            return ampersand.sub(r'\\&', v) if '&' in v else v
+        try:
+            return memo[v]
+        except KeyError:
+            pass
+        if u_escaped:
+            result = u_escape(v).strip().encode('ascii')
+            result = ampersand.sub(r'\\&', result) if '&' in result else result
+        else:
+            result = v.strip().encode('latex', errors).replace(r'\#', '#').replace(r'\\&', r'\&').replace(r'\_', '_')
+        if len(memo) >= memosize:
+            memo.clear()
+        memo[v] = result
+        return result
 
+    return encode
 
-class Ordering(dict):
-    """Key order for iterating over dicts (unknown keys last alphabetic)."""
 
-    _missing = float('inf')
+def externalsorted(records, maxsize=MAXSIZE):
+    """Yield the texts of (key, text) records in stable key order.
+
+    Sorted runs of about maxsize characters are spilled to temporary files
+    and k-way merged, so only one record per run is held in memory.
+    """
+    runs, buf, size = [], [], 0
+    try:
+        for seq, (key, text) in enumerate(records):
+            buf.append((key, seq, text))
+            size += len(text)
+            if size >= maxsize:
+                buf.sort()
+                runs.append(spill(buf))
+                buf, size = [], 0
+        buf.sort()
+        if not runs:
+            for _, _, text in buf:
+                yield text
+            return
+        if buf:
+            runs.append(spill(buf))
+        del buf
+        for _, _, text in heapq.merge(*map(iterspilled, runs)):
+            yield text
+    finally:
+        for r in runs:
+            r.close()
 
-    @classmethod
-    def fromlist(cls, keys):
-        """Define the order of keys as given."""
-        return cls((k, i) for i, k in enumerate(keys))
 
-    def itersorted(self, dct):
-        """Iterate over dct (key, value) pairs in the defined order."""
-        for key in sorted(dct, key=self._itersorted_key):
-            yield key, dct[key]
+def spill(records):
+    """Write records to a temporary file (removed on close), return it rewound."""
+    fd = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(fd, pickle.HIGHEST_PROTOCOL)
+    for r in records:
+        pickler.dump(r)
+        pickler.clear_memo()
+    fd.seek(0)
+    return fd
 
-    def _itersorted_key(self, key):
-         return self[key], key
 
-    def __missing__(self, key):
-        return self._missing
+def iterspilled(fd):
+    load_record = pickle.Unpickler(fd).load
+    while True:
+        try:
+            yield load_record()
+        except EOFError:
+            return
 
 
 fieldorder = Ordering.fromlist(FIELDORDER)
 
 
+CheckError = collections.namedtuple('CheckError', 'filename bibkey lineno error message')
+
+
 def check(filename, encoding=None):
+    """Parse the file once checking syntax, names, and macros.
+
+    Return the number of entries and the list of CheckErrors (a fatal syntax
+    error ends the check of the file and is the last error).
+    """
     parser = CheckParser(encoding=encoding)
-    parser.parse_file(filename)
-    return parser.error_count
-    
+    try:
+        parser.parse_file(filename)
+    except (PybtexError, UnicodeDecodeError) as e:
+        parser.record(e)
+    return parser.entry_count, parser.errors
+
 
 class CheckParser(Parser):
     """Unline BibTeXEntryIterator also parses names, macros, etc."""
 
     def __init__(self, *args, **kwargs):
         super(CheckParser, self).__init__(*args, **kwargs)
-        self.error_count = 0
+        self.entry_count = 0
+        self.errors = []
+        self._last_error = None
+        self._text = None
+        self._start = None
+        self._lines = 0, 1
+
+    @property
+    def error_count(self):
+        return len(self.errors)
+
+    def record(self, error, bibkey=None, lineno=None):
+        """Append a CheckError for error (once), taking bibkey/line from the scanner if possible."""
+        if error is self._last_error:  # re-raised from the entry iterator
+            return
+        self._last_error = error
+        scanner = getattr(error, 'parser', None)
+        if scanner is not None:
+            bibkey = scanner.current_entry_key
+            lineno = error.lineno
+        self.errors.append(CheckError(self.filename, bibkey, lineno,
+            error.__class__.__name__, unicode(error)))
 
     def handle_error(self, error):
-        print('%r' % error)
-        self.error_count += 1
+        self.record(error)
         if not isinstance(error, UndefinedMacro):
             raise error
 
-    def process_entry(self, *args, **kwargs):
+    def parse_string(self, text):
+        """Parse with the scanner of iterentries, keeping entry positions for errors."""
+        self.unnamed_entry_counter = 1
+        self._text = text
+        entries = scanentries(text, spans=True,
+            keyless_entries=self.keyless_entries,
+            handle_error=self.handle_error,
+            want_entry=self.data.want_entry,
+            filename=self.filename,
+            macros=self.macros)
+        for (self._start, _), entry in entries:
+            entry_type = entry[0]
+            entry_type_lower = entry_type.lower()
+            if entry_type_lower == 'string':
+                pass
+            elif entry_type_lower == 'preamble':
+                self.process_preamble(*entry[1])
+            else:
+                self.process_entry(entry_type, *entry[1])
+        return self.data
+
+    def lineno(self, pos):
+        """Return the line number of pos (counting forward from the last call)."""
+        last, lineno = self._lines
+        if pos < last:
+            last, lineno = 0, 1
+        lineno += self._text.count('\n', last, pos)
+        self._lines = pos, lineno
+        return lineno
+
+    def process_entry(self, entry_type, key, fields):
+        self.entry_count += 1
         try:
-            super(CheckParser, self).process_entry(*args, **kwargs)
+            super(CheckParser, self).process_entry(entry_type, key, fields)
         except PybtexError as e:
-            print(e)
-            self.error_count += 1
+            self.record(e, key, self.lineno(self._start))
 
 
 def _test_load():
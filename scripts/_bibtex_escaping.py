@@ -43,10 +43,13 @@ FIXME: tex-escape/character entity mix in anla.bib titlealt
 
 import re
 import codecs
+import collections
 
 import latexcodec
 
-__all__ = ['u_escape', 'u_unescape', 'latex_to_utf8']
+__all__ = ['u_escape', 'u_unescape', 'latex_to_utf8', 'latex_decoder', 'leftover_latex']
+
+CACHESIZE = 10000
 
 LATEX_TABLE = {
     u'\N{LATIN SMALL LETTER ENG}': br'\ng',
@@ -62,58 +65,96 @@ _LC_TABLES = (latexcodec.codec._LATEX_UNICODE_TABLE,)
 
 assert u'\xe4'.encode('latex') == r'\"a'
 assert r'\"a'.decode('latex') == u'\xe4'
+assert u'#$%&_{}~^<>'.encode('latex') == r'\#$%\&\_{}~^<>'  # only #&_ (see requirements.txt)
 
 for unicode_text, latex_text in LATEX_TABLE.iteritems():
     for table in _LC_TABLES:
         table.register(unicode_text, latex_text)
 
 
-def u_escape(s):
-    def iterchunks(s):
-        for c in s:
-            o = ord(c)
-            if o <= 127:
-                yield c
-            else:
-                yield r'?[\u%d]' % o
-
-    return ''.join(iterchunks(s))
+def u_escape(s, pattern=re.compile(u'[^\x00-\x7f]')):
+    """Replace non-ASCII characters with ?[\\uNNN] escapes (decimal code point)."""
+    if pattern.search(s) is None:
+        return s
+    return pattern.sub(lambda m: '?[\\u%d]' % ord(m.group()), s)
 
 
 def u_unescape(s, pattern=re.compile(r'\?\[\\u(\d{3,5})\]')):
-    def iterchunks(s, matches):
-        pos = 0
-        for m in matches:
-            start, end = m.span()
-            yield s[pos:start]
-            yield unichr(int(m.group(1)))
-            pos = end
-        yield s[pos:]
+    """Replace ?[\\uNNN] escapes with the unicode characters."""
+    if '?[\\u' not in s:
+        return s
+    return pattern.sub(lambda m: unichr(int(m.group(1))), s)
+
 
-    return ''.join(iterchunks(s, pattern.finditer(s)))
+def u_escape_encode(input, errors='strict'):
+    return u_escape(input).encode('ascii', errors), len(input)
+
+
+def u_escape_decode(input, errors='strict', final=True,
+                    partial=re.compile(r'\?(?:\[(?:\\(?:u\d{0,5})?)?)?\Z')):
+    """Return (unicode, consumed), keeping back a trailing incomplete escape unless final."""
+    input = bytes(input)
+    end = len(input)
+    if not final:
+        start = input.rfind('?', -10)
+        if start != -1 and partial.match(input, start):
+            end = start
+    return u_unescape(input[:end].decode('ascii', errors)), end
 
 
 class U_escapeCodec(codecs.Codec):
 
-    def encode(self, input, erors='strict'):
-        return u_escape(input.encode('ascii')), len(input)
+    def encode(self, input, errors='strict'):
+        return u_escape_encode(input, errors)
+
+    def decode(self, input, errors='strict'):
+        return u_escape_decode(input, errors)
 
-    def decode(self, input, erors='strict'):
-        return u_unescape(input.decode('ascii')), len(input)
+
+class U_escapeIncrementalEncoder(codecs.IncrementalEncoder):
+
+    def encode(self, input, final=False):
+        return u_escape_encode(input, self.errors)[0]
+
+
+class U_escapeIncrementalDecoder(codecs.BufferedIncrementalDecoder):
+
+    def _buffer_decode(self, input, errors, final):
+        return u_escape_decode(input, errors, final)
 
 
 class U_escapeStreamWriter(U_escapeCodec, codecs.StreamWriter):
     pass
 
 
-class U_escapeStreamReader(U_escapeCodec, codecs.StreamReader):
-    pass
+class U_escapeStreamReader(codecs.StreamReader):
+
+    def __init__(self, stream, errors='strict'):
+        codecs.StreamReader.__init__(self, stream, errors)
+        self.decoder = U_escapeIncrementalDecoder(errors)
+
+    def decode(self, input, errors='strict'):
+        # the decoder keeps back an incomplete escape itself
+        return self.decoder.decode(input), len(input)
+
+    def read(self, size=-1, chars=-1, firstline=False):
+        result = codecs.StreamReader.read(self, size, chars, firstline)
+        if (size < 0 and chars < 0) or (not result and size != 0 and chars != 0):
+            # end of the stream: flush an incomplete escape
+            result += self.decoder.decode(b'', final=True)
+        return result
+
+    def reset(self):
+        codecs.StreamReader.reset(self)
+        self.decoder.reset()
 
 
 def _find_u_escape(encoding):
     if encoding == 'ascii+u_escape':
         return codecs.CodecInfo(name='ascii+u_escape',
-            encode=U_escapeCodec().encode, decode=U_escapeCodec().decode,
+            encode=u_escape_encode, decode=u_escape_decode,
+            incrementalencoder=U_escapeIncrementalEncoder,
+            incrementaldecoder=U_escapeIncrementalDecoder,
             streamwriter=U_escapeStreamWriter, streamreader=U_escapeStreamReader)
 
 
@@ -130,18 +171,60 @@ def latex_to_utf8(s, verbose=True, debracket=re.compile("\{(.)\}")):
     return us
 
 
-platexspc = [re.compile(pattern) for pattern in [
+def latex_decoder(cachesize=CACHESIZE, debracket=re.compile("\{(.)\}"),
+                  trigger=re.compile(r"[^\x20-\x7e]|[\\%$~]|\A | \Z|  |[!?`]`|''|--")):
+    """Return a function decoding like latex_to_utf8, returning (unicode, leftovers).
+
+    leftovers is the tuple of (command, argument) pairs from leftover_latex.
+    Results are kept in a least recently used cache of cachesize values.
+    Values without any trigger of the latex codec are decoded as plain ASCII.
+    """
+    cache = collections.OrderedDict()
+
+    def decode(s):
+        try:
+            result = cache.pop(s)
+        except KeyError:
+            if trigger.search(s) is None:
+                us = s.decode('ascii')
+            else:
+                us = s.decode("latex")
+            us = debracket.sub("\\1", us)
+            result = us, leftover_latex(us)
+            if len(cache) >= cachesize:
+                cache.popitem(last=False)
+        cache[s] = result
+        return result
+
+    return decode
+
+
+PLATEXSPC = [
     r'''\\(?P<typ>[^\%'\`\^\~\=\_\"\s\{]+)\{(?P<ch>[a-zA-Z]?)\}''',
     r'''\\(?P<typ>['\`\^\~\=\_\"]+?)\{(?P<ch>[a-zA-Z])\}''',
     r'\\(?P<typ>[^a-zA-Z\s\%\_])(?P<ch>[a-zA-Z])',
     r'\\(?P<typ>[^a-zA-Z\s\%\{\_]+)(?P<ch>[a-zA-Z])',
     r'\\(?P<typ>[^\{\%\_]+)\{(?P<ch>[^\}]+)\}',
     r'\\(?P<typ>[^\{\_\\\s\%]+)(?P<ch>\s)',
-]]
+]
+
+platexspc = [re.compile(pattern) for pattern in PLATEXSPC]
+
+LEFTOVER_LATEX = re.compile('|'.join(re.sub(r'\(\?P<\w+>', '(', pattern)
+    for pattern in PLATEXSPC))
+
+
+def leftover_latex(txt, pattern=LEFTOVER_LATEX):
+    """Return a tuple of (command, argument) pairs of LaTeX left in decoded txt.
+
+    Single pass over the alternatives of platexspc (leftmost match wins).
+    """
+    if '\\' not in txt:
+        return ()
+    return tuple(m.group(m.lastindex - 1, m.lastindex) for m in pattern.finditer(txt))
 
 
 def remaininglatex(txt):
-    for pattern in platexspc:
-        o = pattern.findall(txt)
-        if o:
-            print o[:100] #txt[o.start()-10:o.start()+10], o.groups()
+    o = leftover_latex(txt)
+    if o:
+        print o[:100]
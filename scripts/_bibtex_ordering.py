@@ -0,0 +1,38 @@
+# _bibtex_ordering.py - memoized key order for iterating over field dicts
+
+__all__ = ['Ordering']
+
+
+class Ordering(dict):
+    """Key order for iterating over dicts (unknown keys last alphabetic)."""
+
+    _missing = float('inf')
+
+    @classmethod
+    def fromlist(cls, keys):
+        """Define the order of keys as given."""
+        return cls((k, i) for i, k in enumerate(keys))
+
+    def __init__(self, *args, **kwargs):
+        super(Ordering, self).__init__(*args, **kwargs)
+        self._sortedkeys = {}
+
+    def sortedkeys(self, dct):
+        """Return the keys of dct as tuple in the defined order (memoized per key set)."""
+        keys = frozenset(dct)
+        try:
+            return self._sortedkeys[keys]
+        except KeyError:
+            result = self._sortedkeys[keys] = tuple(sorted(keys, key=self._itersorted_key))
+            return result
+
+    def itersorted(self, dct):
+        """Iterate over dct (key, value) pairs in the defined order."""
+        for key in self.sortedkeys(dct):
+            yield key, dct[key]
+
+    def _itersorted_key(self, key):
+        return self[key], key
+
+    def __missing__(self, key):
+        return self._missing
@@ -58,9 +58,32 @@ COMMAND1 = re.compile(r'\\text[a-z]+\{([^}]*)\}')
 COMMAND2 = re.compile(r'\\text[a-z]+')
 ACCENT = re.compile(r'''\\[`'^"H~ckl=b.druvt](\{[a-zA-Z]\}|[a-zA-Z])''')
 DROP = re.compile(r'\\[^\s{}]+\{|\\.|[{}]')
+TRIGGER = re.compile(r'[^\x00-\x7f]|[\\{}]')
 
+MEMOSIZE = 100000
 
-def undiacritic(txt):
+
+def undiacritic(txt, memosize=MEMOSIZE, memos={False: {}, True: {}}):
+    """Return str txt without LaTeX commands, accents and braces (unicode is unidecoded).
+
+    Strings without backslash, brace or non-ASCII character are returned directly,
+    other results are memoized (separately for str and unicode, cleared when
+    memosize is reached).
+    """
+    if TRIGGER.search(txt) is None:
+        return str(txt)
+    memo = memos[isinstance(txt, unicode)]
+    try:
+        return memo[txt]
+    except KeyError:
+        result = _undiacritic(txt)
+        if len(memo) >= memosize:
+            memo.clear()
+        memo[txt] = result
+        return result
+
+
+def _undiacritic(txt):
     if isinstance(txt, unicode):
         txt = unidecode(txt)
     txt = REPLACE(txt)
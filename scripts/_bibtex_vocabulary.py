@@ -0,0 +1,92 @@
+# _bibtex_vocabulary.py - title words interned as dense integer ids
+
+import array
+
+__all__ = ['Vocabulary']
+
+
+class Vocabulary(object):
+    """Words mapped to dense integer ids (in order of first occurrence) with counts.
+
+    The word counts are kept in an array indexed by id. For lookups, the
+    vocabulary behaves like a Counter of the words with non-zero count
+    (words interned without being counted are not found by get).
+    """
+
+    @classmethod
+    def fromcounts(cls, items):
+        """Return a vocabulary from (word, count) pairs (ids in the given order)."""
+        self = cls()
+        for word, count in items:
+            self.counts[self.intern(word)] += count
+        return self
+
+    def __init__(self, words=()):
+        self.words = []  # id -> word
+        self.ids = {}  # word -> id
+        self.counts = array.array('l')  # id -> count
+        self.add(words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def __getitem__(self, word):
+        return self.counts[self.ids[word]]
+
+    def get(self, word, default=None):
+        i = self.ids.get(word)
+        if i is None or not self.counts[i]:
+            return default
+        return self.counts[i]
+
+    def iteritems(self):
+        """Yield (word, count) pairs of the words with non-zero count in id order."""
+        for word, count in zip(self.words, self.counts):
+            if count:
+                yield word, count
+
+    def total(self):
+        return sum(self.counts)
+
+    def intern(self, word):
+        """Return the id of word (added with count zero if it is new)."""
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+            self.counts.append(0)
+        return i
+
+    def encode(self, words):
+        """Return the list of ids of the words (interning new ones)."""
+        words = list(words)
+        try:
+            return map(self.ids.__getitem__, words)
+        except KeyError:
+            return map(self.intern, words)
+
+    def add(self, words):
+        """Count each occurrence of the words."""
+        counts = self.counts
+        for i in self.encode(words):
+            counts[i] += 1
+
+    def postings(self, docs):
+        """Return a dict from word id to the array of positions of the docs containing the word.
+
+        docs is an iterable of word sequences, positions are in ascending order.
+        """
+        result = {}
+        for pos, words in enumerate(docs):
+            for i in set(self.encode(words)):
+                if i in result:
+                    result[i].append(pos)
+                else:
+                    result[i] = array.array('l', [pos])
+        return result
@@ -0,0 +1,20 @@
+# _compare_authors.py - compare memoized lastnames with parsing the author names every time
+
+import _bibfiles, _libmonster
+from _compare_util import timed
+
+
+def lastnames(s):
+    return [a['lastname'] for a in _libmonster.pauthor(s)]
+
+
+values = [fields[role] for b in _bibfiles.Collection()
+    for _, (_, fields) in b.iterentries() for role in ('author', 'editor') if role in fields]
+print '%d author/editor fields, %d distinct' % (len(values), len(set(values)))
+
+for v in set(values):
+    assert list(_libmonster.lastnames(v)) == lastnames(v), v
+print 'equivalent'
+
+print 'lastnames: parsed %.2f sec, memoized %.2f sec' % (
+    timed(lastnames, values), timed(_libmonster.lastnames, values))
@@ -0,0 +1,49 @@
+# _compare_index.py - compare single entry lookups by byte span index with load
+
+import os
+import time
+import shutil
+import tempfile
+
+import _bibfiles, _bibtex
+
+SAMPLES = [
+    '@string{foo = {bar}}\n\n@book{a,\n    title = foo\n}\n',
+    '@book{a,\n    title = {x}\n}\n\n@String{foo = "bar"}\n\n@book{b,\n    title = foo # { baz},\n    month = jan\n}\n',
+    '@string{foo = {bar}}\n@string{spam = foo # {eggs}}\n@preamble{"x"}\n@comment{y}\n'
+    '@book{a,\n    title = spam\n}\n@string{foo = {qux}}\n@book{b,\n    title = foo\n}\n',
+]
+
+
+def lookups(filename):
+    entries, strings = _bibtex.index(filename, 'ascii')
+    assert set(entries) == set(_bibtex.load(filename, encoding='ascii'))
+    single = {bibkey: entry for bibkey, offsets in entries.iteritems()
+        for _, entry in _bibtex.iterentries_at(filename, [offsets], 'ascii', strings)}
+    many = dict(_bibtex.iterentries_at(filename, sorted(entries.itervalues()), 'ascii', strings))
+    backwards = dict(_bibtex.iterentries_at(filename, sorted(entries.itervalues(), reverse=True), 'ascii', strings))
+    return single, many, backwards
+
+
+directory = tempfile.mkdtemp()
+try:
+    filename = os.path.join(directory, 'sample.bib')
+    for source in SAMPLES:
+        with open(filename, 'wb') as fd:
+            fd.write(source)
+        expected = _bibtex.load(filename, encoding='ascii')
+        assert all(l == expected for l in lookups(filename)), source
+finally:
+    shutil.rmtree(directory)
+print 'samples identical'
+
+for b in _bibfiles.Collection(cache=None):
+    start = time.time()
+    index = b.index()
+    middle = time.time()
+    entries = b.get_many(index)
+    end = time.time()
+    assert entries == b.load(), b.filename
+    assert all(b[bibkey] == entries[bibkey] for bibkey in sorted(index)[::100])
+    print '%s: %d entries, index %.2f sec, get_many %.2f sec' % (b.filename,
+        len(entries), middle - start, end - middle)
@@ -0,0 +1,33 @@
+# _compare_keyids.py - compare batch keyids with per-entry keyid_words
+
+import time
+
+import _bibfiles, _libmonster
+from _bibtex_vocabulary import Vocabulary
+
+entries = [fields for b in _bibfiles.Collection() for _, (_, fields) in b.iterentries()]
+
+start = time.time()
+words, titlewords = Vocabulary(), []
+for fields in entries:  # counting pass as in _bibfiles_db.count_titlewords
+    if 'title' in fields:
+        tks = _libmonster.wrds(fields['title'])
+        words.add(tks)
+        titlewords.append(_libmonster.keyid_types(tks))
+    else:
+        titlewords.append(None)
+print '%d entries, %d title words, counted in %.2f sec' % (len(entries), len(words), time.time() - start)
+
+for ti in (1, 2, 3):
+    expected = [_libmonster.keyid_words(fields, words, ti) for fields in entries]
+    assert _libmonster.keyids(entries, words, ti) == expected
+    assert _libmonster.keyids(entries, words, ti, titlewords=titlewords) == expected
+print 'identical'
+
+for _ in range(3):
+    start = time.time()
+    for fields in entries:
+        _libmonster.keyid_words(fields, words)
+    middle = time.time()
+    _libmonster.keyids(entries, words, titlewords=titlewords)
+    print 'keyid_words %.2f sec, keyids with counted title words %.2f sec' % (middle - start, time.time() - middle)
@@ -0,0 +1,43 @@
+# _compare_latex_encoder.py - compare fast-pathed latex_encoder with the latexcodec expression of dump
+
+import _bibfiles, _bibtex
+from _bibtex_escaping import u_escape
+from _compare_util import timed
+
+SAMPLES = [
+    u'', u'  ', u' a ', u'#', u'&', u'_', u'\\&', u'\\\\&', u'a & b', u'a \\& b',
+    u'\\#\\_', u'$x^2$ 100% {~} <>', u'\\textbf{x}', u'\\"a',
+    u'\xe4', u' \xe4 & # _ ', u'\\&\xe4&', u'\u014b\u0254 & \\& co', u'\xa0x\xa0',
+]
+
+
+def encode(v, u_escaped, errors='strict'):
+    v = u_escape(v) if u_escaped else v
+    return v.strip().encode('latex', errors).replace(r'\#', '#').replace(r'\\&', r'\&').replace(r'\_', '_')
+
+
+def outcome(func, v):
+    try:
+        result = func(v)
+    except ValueError as e:  # unencodable
+        return type(e)
+    return type(result), result
+
+
+values = SAMPLES + list({v for b in _bibfiles.Collection() if b.encoding in ('ascii', 'ascii+u_escape')
+    for _, (_, fields) in b.iterentries() for k, v in fields.iteritems() if k not in _bibtex.VERBATIM})
+encodable = [v for v in values if outcome(lambda v: encode(v, False), v) is not ValueError]
+print '%d values, %d non-ascii, %d latex-encodable' % (len(values),
+    sum(any(c > u'\x7f' for c in v) for v in values), len(encodable))
+
+for u_escaped in (False, True):
+    fast = _bibtex.latex_encoder(u_escaped=u_escaped)
+    for v in values:
+        expected = outcome(lambda v: encode(v, u_escaped), v)
+        assert outcome(fast, v) == outcome(fast, v) == expected, (u_escaped, v)  # computed and memoized
+print 'identical'
+
+for u_escaped in (False, True):
+    print 'u_escaped=%r: latexcodec %.2f sec, latex_encoder %.2f sec' % (u_escaped,
+        timed(lambda v: encode(v, u_escaped), encodable, repeat=1),
+        timed(_bibtex.latex_encoder(u_escaped=u_escaped), encodable, repeat=1))
@@ -0,0 +1,48 @@
+# _compare_pitems.py - compare single-scan pitems with the previous four findall scans per entry
+
+import time
+
+import _bibfiles, _bibtex, _libmonster
+from _libmonster import reitem, retypekey, refields, refieldsacronym, refieldsnum, refieldslast
+
+
+def pitems(txt):
+    for m in reitem.finditer(txt):
+        item = m.group()
+        o = retypekey.search(item)
+        if o is None:
+            continue
+        key = o.group("key")
+        typ = o.group("type")
+        fields = refields.findall(item) + refieldsacronym.findall(item) + refieldsnum.findall(item) + refieldslast.findall(item)
+        fieldslower = ((x.lower(), y) for x, y in fields)
+        yield key, typ.lower(), dict(fieldslower)
+
+
+SAMPLES = [
+    _libmonster.trf,
+    '@Article{a,\n  title = {a}, year = 1993,\n  note = {see p = 12,\n 13},\n  pages = 12\n}',
+    '@Misc{b,\r\n  Title = "x = {5}",\r\n  title = {y},\r\n  url = {http://x.org/?a=b&c=1,\r\n  year = {1993}}',
+    '@Book{c,\n\n  author = {A and B},\n  volume = III,\n  number = 3,\n  YEAR = 1993,\n}\n@Book{d\n}',
+]
+
+for sample in SAMPLES:
+    assert list(_libmonster.pitems(sample)) == list(pitems(sample)), sample
+
+durations = [0, 0]
+for b in _bibfiles.Collection():
+    with _bibtex.memorymapped(b.filepath) as source:
+        start = time.time()
+        expected = list(pitems(source))
+        middle = time.time()
+        result = list(_libmonster.pitems(source))
+        durations[0] += middle - start
+        durations[1] += time.time() - middle
+    if result != expected:
+        for x, y in zip(expected, result):
+            if x != y:
+                print b.filename, x[0]
+                print sorted(set(x[2].iteritems()).symmetric_difference(y[2].iteritems()))
+    print '%s: %d entries %s' % (b.filename, len(result), 'OK' if result == expected else 'DIFFERENT')
+
+print 'pitems: four scans %.2f sec, single scan %.2f sec' % tuple(durations)
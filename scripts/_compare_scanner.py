@@ -0,0 +1,49 @@
+# _compare_scanner.py - compare canonical layout scanner with pybtex bibfile parsing
+
+import time
+
+import _bibfiles, _bibtex
+
+SAMPLES = [
+    '@comment{foo,\n}\n',
+    '@Comment{foo,\n}\n@book{a,\n    title = {x}\n}\n',
+    '@preamble{foo,\n}\n',
+    '@PREAMBLE{"x"}\n@book{a,\n}\n',
+    '@String{foo,\n}\n@book{a,\n    title = {x}\n}\n',
+    '@string{foo = {bar}}\n@book{a,\n    title = foo\n}\n',
+    '@book{a,\n    title = {x}\n}\n\n@book{b,\n  title = {y},\n}\n\n@book{c,\n  title = {z}\n',
+]
+
+
+def parsed(iterentries, source):
+    try:
+        return list(iterentries(source))
+    except Exception as e:
+        return type(e).__name__, str(e), getattr(e, 'lineno', None)
+
+
+for source in SAMPLES:
+    assert parsed(_bibtex.scanentries, source) == parsed(_bibtex.BibTeXEntryIterator, source), source
+
+total = {True: 0.0, False: 0.0}
+
+for b in _bibfiles.Collection():
+    timings = {}
+    results = {}
+    for use_scanner in (False, True):
+        start = time.time()
+        results[use_scanner] = list(_bibtex.iterentries(b.filepath,
+            encoding=b.encoding, use_pybtex=b.use_pybtex, use_scanner=use_scanner))
+        timings[use_scanner] = time.time() - start
+        total[use_scanner] += timings[use_scanner]
+    print '%s: %d entries, pybtex %.2f sec, scanner %.2f sec' % (b.filename,
+        len(results[False]), timings[False], timings[True])
+    if results[True] != results[False]:
+        for x, y in zip(results[False], results[True]):
+            if x != y:
+                print repr(x)
+                print repr(y)
+                break
+        raise RuntimeError('scanner output differs: %s' % b.filename)
+
+print 'total: pybtex %.2f sec, scanner %.2f sec' % (total[False], total[True])
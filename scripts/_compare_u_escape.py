@@ -0,0 +1,79 @@
+# _compare_u_escape.py - compare regex-based with previous generator-based u_escape/u_unescape
+
+import codecs
+import random
+import StringIO
+
+import _bibfiles, _bibtex_escaping
+from _compare_util import timed
+
+
+def u_escape(s):
+    def iterchunks(s):
+        for c in s:
+            o = ord(c)
+            if o <= 127:
+                yield c
+            else:
+                yield r'?[\u%d]' % o
+
+    return ''.join(iterchunks(s))
+
+
+def u_unescape(s, pattern=_bibtex_escaping.re.compile(r'\?\[\\u(\d{3,5})\]')):
+    def iterchunks(s, matches):
+        pos = 0
+        for m in matches:
+            start, end = m.span()
+            yield s[pos:start]
+            yield unichr(int(m.group(1)))
+            pos = end
+        yield s[pos:]
+
+    return ''.join(iterchunks(s, pattern.finditer(s)))
+
+
+values = [v for b in _bibfiles.Collection() if b.encoding == 'ascii+u_escape'
+    for _, (_, fields) in b.iterentries() for v in fields.itervalues()]
+escaped = [u_escape(v).encode('ascii') for v in values]
+print '%d values, %d with escapes' % (len(values), sum('?[\\u' in e for e in escaped))
+
+for v, e in zip(values, escaped):
+    assert _bibtex_escaping.u_escape(v) == u_escape(v)
+    assert _bibtex_escaping.u_unescape(e) == u_unescape(e)
+    assert type(_bibtex_escaping.u_unescape(e)) is type(u_unescape(e))
+    assert e.decode('ascii+u_escape') == u_unescape(e.decode('ascii'))
+
+for name, old, new, args in [
+        ('u_escape', u_escape, _bibtex_escaping.u_escape, values),
+        ('u_unescape', u_unescape, _bibtex_escaping.u_unescape, escaped)]:
+    print '%s: previous %.2f sec, current %.2f sec' % (name, timed(old, args), timed(new, args))
+
+# incremental decoding with escapes split across buffer boundaries
+data = '\n'.join(e for e in escaped if '?[\\u' in e)[:100000]
+expected = u_unescape(data.decode('ascii'))
+for _ in range(10):
+    decoder = codecs.getincrementaldecoder('ascii+u_escape')()
+    pos, chunks = 0, []
+    while pos < len(data):
+        size = random.randint(1, 12)
+        chunks.append(decoder.decode(data[pos:pos + size]))
+        pos += size
+    chunks.append(decoder.decode('', final=True))
+    assert u''.join(chunks) == expected
+print 'incremental decoder OK'
+
+# stream reading, with an incomplete escape at the end of the stream
+for tail in ['', '?[\\u12']:
+    stream = lambda: codecs.getreader('ascii+u_escape')(StringIO.StringIO(data + tail))
+    assert stream().read() == expected + tail
+    assert stream().readlines() == (expected + tail).splitlines(True)
+    for _ in range(10):
+        reader, chunks = stream(), []
+        while True:
+            chunk = reader.read(random.randint(1, 12))
+            if not chunk:
+                break
+            chunks.append(chunk)
+        assert u''.join(chunks) == expected + tail
+print 'stream reader OK'
@@ -0,0 +1,29 @@
+# _compare_undiacritic.py - compare fast-pathed memoized undiacritic with the plain regex passes
+
+import _bibfiles, _libmonster, _bibtex_undiacritic
+from _compare_util import timed
+
+
+values = []
+
+
+def undiacritic(txt, _undiacritic=_libmonster.undiacritic):
+    values.append(txt)
+    return _undiacritic(txt)
+
+
+_libmonster.undiacritic = undiacritic
+for b in _bibfiles.Collection():
+    for _, (_, fields) in b.iterentries():
+        _libmonster.keyid(fields)
+_libmonster.undiacritic = _bibtex_undiacritic.undiacritic
+print '%d undiacritic calls from keyid, %d distinct' % (len(values), len(set(values)))
+
+for v in values:
+    expected = _bibtex_undiacritic._undiacritic(v)
+    result = _bibtex_undiacritic.undiacritic(v)
+    assert result == expected and type(result) is type(expected), v
+print 'identical'
+
+print 'undiacritic: plain %.2f sec, fast-pathed memoized %.2f sec' % (
+    timed(_bibtex_undiacritic._undiacritic, values), timed(_bibtex_undiacritic.undiacritic, values))
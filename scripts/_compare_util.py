@@ -0,0 +1,14 @@
+# _compare_util.py - helpers shared by the _compare_*.py scripts
+
+import time
+
+__all__ = ['timed']
+
+
+def timed(func, values, repeat=3):
+    """Return the mean duration in seconds of calling func on each of values."""
+    start = time.time()
+    for _ in range(repeat):
+        for v in values:
+            func(v)
+    return (time.time() - start) / repeat
@@ -5,15 +5,20 @@
 
 import re
 import csv
+import array
+import operator
+import itertools
 from collections import namedtuple
 from heapq import nsmallest
 from ConfigParser import RawConfigParser
 
+from _bibtex_ordering import Ordering
 from _bibtex_undiacritic import undiacritic
+from _bibtex_vocabulary import Vocabulary
 
 __all__ = [
     'add_inlg_e',
-    'keyid',
+    'keyid', 'keyid_words', 'keyids', 'keyid_types', 'rarewords', 'pauthor', 'lastnames',
     'wrds', 'setd', 'setd3', 'indextrigs',
     'lstat', 'lstat_witness', 
     'hhtype_to_n', 'expl_to_hhtype', 'lgcode',
@@ -24,6 +29,8 @@ __all__ = [
 INLG = '../references/alt4inlg.ini'
 HHTYPE = '../references/alt4hhtype.ini'
 
+MEMOSIZE = 100000
+
 
 def read_csv_dict(filename):
     return {row[0]: row for row in csv_iterrows(filename)}
@@ -154,6 +161,18 @@ def pauthor(s):
     return [a for a in pas if a]
 
 
+def lastnames(s, memo={}, memosize=MEMOSIZE):
+    """Return the tuple of lastnames from pauthor(s) (memoized, cleared when memosize is reached)."""
+    try:
+        return memo[s]
+    except KeyError:
+        result = tuple(a['lastname'] for a in pauthor(s))
+        if len(memo) >= memosize:
+            memo.clear()
+        memo[s] = result
+        return result
+
+
 #"Adam, A., W.B. Wood, C.P. Symons, I.G. Ord & J. Smith"
 #"Karen Adams, Linda Lauck, J. Miedema, F.I. Welling, W.A.L. Stokhof, Don A.L. Flassy, Hiroko Oguri, Kenneth Collier, Kenneth Gregerson, Thomas R. Phinnemore, David Scorza, John Davies, Bernard Comrie & Stan Abbott"
 
@@ -222,9 +241,21 @@ refieldslast = re.compile('\s*(?P<field>[a-zA-Z\_]+)\s*=\s*[\{\"]?(?P<data>[^\r\
 retypekey = re.compile("@(?P<type>[a-zA-Z]+){(?P<key>[^,\s]*)[,\r\n]")
 reitem = re.compile("@[a-zA-Z]+{[^@]+}")
 
+# the field patterns as one alternation in order of precedence (later ones win),
+# groups renamed to <name>_<i> inside an unnamed group per alternative
+REFIELDS = [refields, refieldsacronym, refieldsnum, refieldslast]
+
+refieldsall = re.compile('|'.join('(%s)' % re.sub(r'\(\?P<(\w+)>', r'(?P<\1_%d>' % i, pattern.pattern)
+    for i, pattern in enumerate(REFIELDS)))
+
+# lastindex (alternative group) -> (precedence, field group, data group)
+_refieldsall_groups = {refieldsall.groupindex['field_%d' % i] - 1: (i,
+    refieldsall.groupindex['field_%d' % i], refieldsall.groupindex['data_%d' % i])
+    for i in range(len(REFIELDS))}
+
 trf = '@Book{g:Fourie:Mbalanhu,\n  author =   {David J. Fourie},\n  title =    {Mbalanhu},\n  publisher =    LINCOM,\n  series =       LWM,\n  volume =       03,\n  year = 1993\n}'
 
-def pitems(txt):
+def pitems(txt, get_precedence=operator.itemgetter(0)):
     for m in reitem.finditer(txt):
         item = m.group()
         o = retypekey.search(item)
@@ -232,16 +263,17 @@ def pitems(txt):
             continue
         key = o.group("key")
         typ = o.group("type")
-        fields = refields.findall(item) + refieldsacronym.findall(item) + refieldsnum.findall(item) + refieldslast.findall(item)
-        fieldslower = ((x.lower(), y) for x, y in fields)
-        yield key, typ.lower(), dict(fieldslower)
+        # single scan, stable sort by pattern = concatenated findall results of each pattern
+        fields = sorted(((_refieldsall_groups[f.lastindex], f) for f in refieldsall.finditer(item)),
+            key=get_precedence)
+        yield key, typ.lower(), {f.group(field).lower(): f.group(data) for (_, field, data), f in fields}
 
 
 #	Author = ac # { and Howard Coate},
 #	Author = ad,
 
 
-bibord = {k: i for i, k in enumerate([
+bibord = Ordering.fromlist([
     'author',
     'editor',
     'title',
@@ -257,11 +289,9 @@ bibord = {k: i for i, k in enumerate([
     'year',
     'issn',
     'url',
-])}
+])
 
-def bibord_iteritems(fields, sortkey=lambda f, inf=float('inf'): (bibord.get(f, inf), f)):
-    for f in sorted(fields, key=sortkey):
-        yield f, fields[f]
+bibord_iteritems = bibord.itersorted
 
 
 resplittit = re.compile("[\(\)\[\]\:\,\.\s\-\?\!\;\/\~\=]+")
@@ -281,12 +311,14 @@ def renfn(e, ups):
     return e
 
 
-def add_inlg_e(e):
+def add_inlg_e(e, vocabulary=None):
+    if vocabulary is None:
+        vocabulary = Vocabulary()
     inlg = load_triggers(INLG, sec_curly_to_square=True)
     # FIXME: does not honor 'NOT' for now
-    dh = {word: label  for (cls, label), triggers in inlg.iteritems()
+    dh = {vocabulary.intern(word): label  for (cls, label), triggers in inlg.iteritems()
         for t in triggers for flag, word in t}  
-    ts = [(k, wrds(fields['title']) + wrds(fields.get('booktitle', ''))) for (k, (typ, fields)) in e.iteritems() if fields.has_key('title') and not fields.has_key('inlg')]
+    ts = [(k, vocabulary.encode(wrds(fields['title']) + wrds(fields.get('booktitle', '')))) for (k, (typ, fields)) in e.iteritems() if fields.has_key('title') and not fields.has_key('inlg')]
     print len(ts), "without", 'inlg'
     ann = [(k, set(dh[w] for w in tit if dh.has_key(w))) for (k, tit) in ts]
     unique = [(k, lgs.pop()) for (k, lgs) in ann if len(lgs) == 1]
@@ -295,10 +327,14 @@ def add_inlg_e(e):
     t2 = renfn(e, fnups)
     #print len(unique), "updates"
 
-    newtrain = grp2fd([(lgcodestr(fields['inlg'])[0], w) for (k, (typ, fields)) in t2.iteritems() if fields.has_key('title') and fields.has_key('inlg') if len(lgcodestr(fields['inlg'])) == 1 for w in wrds(fields['title'])])
+    newtrain = grp2fd([(lgcodestr(fields['inlg'])[0], w) for (k, (typ, fields)) in t2.iteritems() if fields.has_key('title') and fields.has_key('inlg') if len(lgcodestr(fields['inlg'])) == 1 for w in vocabulary.encode(wrds(fields['title']))])
     #newtrain = grp2fd([(cname(lgc), w) for (lgcs, w) in alc if len(lgcs) == 1 for lgc in lgcs])
+    totals = array.array('l', [0]) * len(vocabulary)  # word id -> count over all languages
+    for wf in newtrain.itervalues():
+        for (w, f) in wf.iteritems():
+            totals[w] += f
     for (lg, wf) in sorted(newtrain.iteritems(), key=lambda x: len(x[1])):
-        cm = [(1+f, float(1-f+sum(owf.get(w, 0) for owf in newtrain.itervalues())), w) for (w, f) in wf.iteritems() if f > 9]
+        cm = [(1+f, float(1-f+totals[w]), vocabulary.words[w]) for (w, f) in wf.iteritems() if f > 9]
         cms = [(f/fn, f, fn, w) for (f, fn, w) in cm]
         cms.sort(reverse=True)
         ##print lg, cms[:10]
@@ -359,31 +395,78 @@ rewrdtok = re.compile("[a-zA-Z].+")
 reokkey = re.compile("[^a-z\d\-\_\[\]]")
 
 def keyid(fields, fd={}, ti=2, infinity=float('inf')):
+    return keyid_words(fields, fd, ti, infinity)[0]
+
+
+def keyid_words(fields, fd={}, ti=2, infinity=float('inf')):
+    """Return (keyid, title word types, selected rare words).
+
+    The word lists are None if the keyid does not depend on the frequencies.
+    """
+    head, types, tail = keyid_parts(fields)
+    if types is None:
+        return head, None, None
+    tk = rarewords(types, fd, ti, infinity)
+    key = head + '-'.join(tk) + tail
+    return reokkey.sub("", key.lower()), types, tk
+
+
+def keyids(entries, vocabulary, ti=2, infinity=float('inf'), titlewords=None):
+    """Return the list of keyid_words results for a sequence of fields dicts.
+
+    The frequencies are read from the id/count arrays of the shared title word
+    Vocabulary (words with zero count are infinitely rare). titlewords is an
+    optional parallel sequence of title word types (see keyid_types) from the
+    counting pass, None items are tokenized from the title as in keyid_words.
+    """
+    ids, counts = vocabulary.ids.get, vocabulary.counts
+    if titlewords is None:
+        titlewords = itertools.repeat(None)
+    result = []
+    for fields, types in itertools.izip(entries, titlewords):
+        head, types, tail = keyid_parts(fields, types)
+        if types is None:
+            result.append((head, None, None))
+            continue
+        if len(types) <= ti:
+            tk = types[:]
+        else:
+            freqs = [counts[i] or infinity if i is not None else infinity
+                for i in map(ids, types)]
+            positions = sorted(xrange(len(types)), key=freqs.__getitem__)[:ti]
+            positions.sort()
+            tk = map(types.__getitem__, positions)
+        key = head + '-'.join(tk) + tail
+        result.append((reokkey.sub("", key.lower()), types, tk))
+    return result
+
+
+def keyid_parts(fields, types=None):
+    """Return (head, title word types, tail) of the keyid around the rare words.
+
+    If the keyid does not depend on the title words, return (keyid, None, None).
+    Pass the types if they are already known (see keyid_types).
+    """
     if not fields.has_key('author'):
         if not fields.has_key('editor'):
             values = ''.join(v for f, v in bibord_iteritems(fields)
                 if f != 'glottolog_ref_id')
-            return '__missingcontrib__' + reokkey.sub('_', values.lower())
+            return '__missingcontrib__' + reokkey.sub('_', values.lower()), None, None
         else:
             astring = fields['editor']
     else:
         astring = fields['author']
 
-    authors = pauthor(astring)
+    authors = lastnames(astring)
     if len(authors) != len(astring.split(' and ')):
         print "Unparsed author in", authors
         print "   ", astring, astring.split(' and ')
         print fields['title']
 
-    ak = [undiacritic(x) for x in sorted(lastnamekey(a['lastname']) for a in authors)]
+    ak = [undiacritic(x) for x in sorted(lastnamekey(a) for a in authors)]
     yk = pyear(fields.get('year', '[nd]'))[:4]
-    tks = wrds(fields.get("title", "no.title")) #takeuntil :
-    # select the (leftmost) two least frequent words from the title
-    types = uniqued(w for w in tks if rewrdtok.match(w))
-    tk = nsmallest(ti, types, key=lambda w: fd.get(w, infinity))
-    # put them back into the title order (i.e. 'spam eggs' != 'eggs spam')
-    order = {w: i for i, w in enumerate(types)}
-    tk.sort(key=lambda w: order[w])
+    if types is None:
+        types = keyid_types(wrds(fields.get("title", "no.title"))) #takeuntil :
     if fields.has_key('volume') and not fields.has_key('journal') and not fields.has_key('booktitle') and not fields.has_key('series'):
         vk = roman(fields['volume'])
     else:
@@ -392,8 +475,21 @@ def keyid(fields, fd={}, ti=2, infinity=float('inf')):
     if fields.has_key('extra_hash'):
         yk = yk + fields['extra_hash']
 
-    key = '-'.join(ak) + "_" + '-'.join(tk) + vk + yk
-    return reokkey.sub("", key.lower())
+    return '-'.join(ak) + "_", types, vk + yk
+
+
+def keyid_types(tks):
+    """Return the title word types the rare words are selected from (tks from wrds)."""
+    return uniqued(w for w in tks if rewrdtok.match(w))
+
+
+def rarewords(types, fd, ti=2, infinity=float('inf')):
+    # select the (leftmost) two least frequent words from the title
+    tk = nsmallest(ti, types, key=lambda w: fd.get(w, infinity))
+    # put them back into the title order (i.e. 'spam eggs' != 'eggs spam')
+    order = {w: i for i, w in enumerate(types)}
+    tk.sort(key=lambda w: order[w])
+    return tk
 
 
 def uniqued(items):
@@ -101,8 +101,7 @@ class SubclassJust(Justifications):
 
 
 def check_refs():
-    db = BIBFILES.to_sqlite()
-    known = db.to_hhmapping()
+    known = BIBFILES['hh.bib'].index()
     print(len(known))
 
     for rows in (FamilyJust(), SubclassJust()):
@@ -52,6 +52,7 @@ import time
 
 import _bibfiles
 import _libmonster as bib
+from _bibtex_vocabulary import Vocabulary
 
 BIBFILES = _bibfiles.Collection()
 PREVIOUS = '../references/monster.csv'
@@ -72,8 +73,8 @@ def intersectall(xs):
     return a
 
 
-def markconservative(m, trigs, ref, outfn="monstermarkrep.txt", blamefield="hhtype"):
-    mafter = markall(m, trigs)
+def markconservative(m, trigs, ref, outfn="monstermarkrep.txt", blamefield="hhtype", vocabulary=None):
+    mafter = markall(m, trigs, vocabulary=vocabulary)
     ls = bib.lstat(ref)
     #print bib.fd(ls.values())
     lsafter = bib.lstat_witness(mafter)
@@ -93,24 +94,30 @@ def markconservative(m, trigs, ref, outfn="monstermarkrep.txt", blamefield="hhty
     return mafter
 
 
-def markall(e, trigs, labelab=lambda x: x):
+def markall(e, trigs, labelab=lambda x: x, vocabulary=None):
+    if vocabulary is None:
+        vocabulary = Vocabulary()
     clss = set(cls for (cls, _) in trigs.iterkeys())
     ei = dict((k, (typ, fields)) for (k, (typ, fields)) in e.iteritems() if [c for c in clss if not fields.has_key(c)])
 
-    wk = {}
-    for (k, (typ, fields)) in ei.iteritems():
-        for w in bib.wrds(fields.get('title', '')):
-            bib.setd(wk, w, k)
+    keys = list(ei)
+    postings = vocabulary.postings(bib.wrds(ei[k][1].get('title', '')) for k in keys)
+
+    def wk(w):
+        return postings.get(vocabulary.ids.get(w), ())
 
     u = {}
     it = bib.indextrigs(trigs)
     for (dj, clslabs) in it.iteritems():
-        mkst = [wk.get(w, {}).iterkeys() for (stat, w) in dj if stat]
-        mksf = [set(ei.iterkeys()).difference(wk.get(w, [])) for (stat, w) in dj if not stat]
-        mks = intersectall(mkst + mksf)
-        for k in mks:
+        mkst = [wk(w) for (stat, w) in dj if stat]
+        mksf = [wk(w) for (stat, w) in dj if not stat]
+        # positions of the titles with all of mkst and none of mksf
+        mks = intersectall(mkst) if mkst else set(xrange(len(keys)))
+        for ps in mksf:
+            mks.difference_update(ps)
+        for i in mks:
             for cl in clslabs:
-                bib.setd3(u, k, cl, dj)
+                bib.setd3(u, keys[i], cl, dj)
 
     for (k, cd) in u.iteritems():
         (t, f) = e[k]
@@ -139,12 +146,19 @@ def macro_area_from_lgcode(m, lginfo=LGINFO):
     return dict((k, inject_macro_area(tf)) for k, tf in m.iteritems())
 
 
-def main(bibfiles=BIBFILES, previous=PREVIOUS, replacements=REPLACEMENTS, monster=MONSTER):
+def main(bibfiles=BIBFILES, previous=PREVIOUS, replacements=REPLACEMENTS, monster=MONSTER,
+         trickle_inplace=False):
+    """Compile the monster, trickle new glottolog_ref_ids back into the bibfiles.
+
+    With trickle_inplace, only the changed entries are rewritten in the
+    bibfiles (see Database.trickle): the other entries are not re-normalized.
+    """
     print '%s open/rebuild bibfiles db' % time.ctime()
     db = bibfiles.to_sqlite()
 
     print '%s compile_monster' % time.ctime()
     m = dict(db.merged())
+    vocabulary = db.vocabulary()
 
     print '%s load hh.bib' % time.ctime()
     hhbib = bibfiles['hh.bib'].load()
@@ -156,16 +170,16 @@ def main(bibfiles=BIBFILES, previous=PREVIOUS, replacements=REPLACEMENTS, monste
     # Annotate with hhtype
     print '%s annotate hhtype' % time.ctime()
     hht = dict(((cls, bib.expl_to_hhtype[lab]), v) for ((cls, lab), v) in bib.load_triggers(HHTYPE).iteritems())
-    m = markconservative(m, hht, hhbib, outfn=MARKHHTYPE, blamefield="hhtype")
+    m = markconservative(m, hht, hhbib, outfn=MARKHHTYPE, blamefield="hhtype", vocabulary=vocabulary)
 
     # Annotate with lgcode
     print '%s annotate lgcode' % time.ctime()
     lgc = bib.load_triggers(LGCODE, sec_curly_to_square=True)
-    m = markconservative(m, lgc, hhbib, outfn=MARKLGCODE, blamefield="hhtype")
+    m = markconservative(m, lgc, hhbib, outfn=MARKLGCODE, blamefield="hhtype", vocabulary=vocabulary)
 
     # Annotate with inlg
     print '%s add_inlg_e' % time.ctime()
-    m = bib.add_inlg_e(m)
+    m = bib.add_inlg_e(m, vocabulary)
 
     # Print some statistics
     print time.ctime()
@@ -183,11 +197,12 @@ def main(bibfiles=BIBFILES, previous=PREVIOUS, replacements=REPLACEMENTS, monste
 
     # Trickling back
     print '%s trickle' % time.ctime()
-    db.trickle()
+    db.trickle(inplace=trickle_inplace)
 
     # Save
     print '%s save as utf8' % time.ctime()
-    monster.save(m, verbose=False)
+    diagnostics = monster.save(m, verbose=False)
+    print '%d values with leftover latex' % len(diagnostics)
 
     print '%s done.' % time.ctime()
 